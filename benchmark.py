@@ -0,0 +1,100 @@
+"""Micro-benchmarks for the storage layer.
+
+    uv run benchmark.py startup --events 1000000
+    uv run benchmark.py toggles --ops 5000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import database
+import storage
+from writebehind import WriteBehindStorage
+
+def build_large_db(path, events):
+    database.init_db(path)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        """
+        INSERT INTO smoke_events (chat_id, user_id, timestamp, local_day)
+        VALUES (:chat, :user, datetime('now', :ago), date('now', :ago))
+        """,
+        ({"chat": i % 50, "user": i % 500, "ago": f"-{i % 365} days"} for i in range(events))
+    )
+    conn.executemany(
+        """
+        INSERT INTO smoke_participation (user_id, chat_id, message_id, timestamp, local_day)
+        VALUES (:user, :chat, :message, datetime('now', :ago), date('now', :ago))
+        """,
+        ({"chat": i % 50, "user": i % 500, "message": i, "ago": f"-{i % 365} days"} for i in range(events))
+    )
+    conn.commit()
+    conn.close()
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_large_db(path, args.events)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            database.init_db(path)
+            timings.append(time.perf_counter() - start)
+
+    print(
+        f"init_db on an up-to-date {size_mb:.1f} MB database ({args.events} events): "
+        f"median {statistics.median(timings) * 1000:.3f} ms, best {min(timings) * 1000:.3f} ms "
+        f"over {args.runs} runs"
+    )
+
+def _run_toggles(store, ops, seed):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(ops):
+        store.toggle_smoke_participation(rng.randrange(50), 1, rng.randrange(20))
+    # close() returns once every write is committed, so this is sustained throughput.
+    store.close()
+    return time.perf_counter() - start
+
+def bench_toggles(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, wrap in (("direct", lambda inner: inner), ("write-behind", WriteBehindStorage)):
+            inner = storage.SQLiteStorage(os.path.join(tmp, f"{name}.db"))
+            inner.init()
+            results[name] = _run_toggles(wrap(inner), args.ops, args.seed)
+            print(f"{name:>12}: {args.ops / results[name]:10.0f} toggles/s ({args.ops} toggles in {results[name]:.2f} s)")
+
+        # Both runs replay the same toggles, so they must end in the same state.
+        states = [
+            sqlite3.connect(os.path.join(tmp, f"{name}.db")).execute(
+                "SELECT user_id, chat_id, message_id FROM smoke_participation ORDER BY 1, 2, 3"
+            ).fetchall()
+            for name in results
+        ]
+        print(f"final RSVP state identical: {states[0] == states[1]}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    startup = commands.add_parser("startup", help="time init_db() against a large, migrated database")
+    startup.add_argument("--events", type=int, default=200_000)
+    startup.add_argument("--runs", type=int, default=50)
+    startup.set_defaults(func=bench_startup)
+
+    toggles = commands.add_parser("toggles", help="sustained RSVP toggles/s, direct vs write-behind")
+    toggles.add_argument("--ops", type=int, default=5000)
+    toggles.add_argument("--seed", type=int, default=1)
+    toggles.set_defaults(func=bench_toggles)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
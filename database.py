@@ -1,6 +1,12 @@
 import sqlite3
+import datetime
 import logging
 import os
+import pathlib
+import threading
+import time
+import weakref
+import zoneinfo
 
 logger = logging.getLogger(__name__)
 file_handler = logging.FileHandler('bot.log')
@@ -10,50 +16,192 @@ logger.setLevel(logging.INFO)
 
 DB_PATH = os.getenv("DB_PATH", "smoke_bot.db")
 
-def init_db(db_path=None):
-    if db_path is None:
-        db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
+# Raw events older than this many days are folded into smoke_totals by run_maintenance().
+# Every windowed query looks back at most 30 days, so the horizon never goes below that.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+MIN_RETENTION_DAYS = 31
+VACUUM_STEP_PAGES = 256
+
+# "Today", "week" and "month" are counted in the chat's local days. Chats without an
+# explicit /smoke_timezone use this zone.
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Almaty")
+PERIOD_DAYS = {'today': 1, 'week': 7, 'month': 30}
+
+_chat_timezones = {}
+
+# Opt-in query profiler. Enable with DB_PROFILE=1 (or enable_profiling() at runtime);
+# statements slower than DB_SLOW_QUERY_MS are logged together with their query plan.
+PROFILE_ENABLED = os.getenv("DB_PROFILE", "0") == "1"
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))
+
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+
+def _normalize_sql(sql):
+    return " ".join(sql.split())
+
+def _record_query(sql, elapsed):
+    key = _normalize_sql(sql)
+    with _query_stats_lock:
+        stats = _query_stats.get(key)
+        if stats is None:
+            stats = _query_stats[key] = {"calls": 0, "total": 0.0, "max": 0.0}
+        stats["calls"] += 1
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that times execute() and the fetches that follow it.
+
+    SQLite evaluates lazily, so most of the work of a SELECT happens while rows are
+    being fetched; fetch time is attributed to the statement that produced the rows.
+    """
+
+    _sql = None
+    _params = ()
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql, self._params = sql, parameters
+            self._elapsed = time.perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # EXPLAIN of an executemany statement would need a parameter set; skip it.
+            self._sql, self._params = sql, None
+            self._elapsed = time.perf_counter() - start
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._timed_fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Cursors from Connection.execute() are often dropped without close().
+        self._finish()
+
+    def _finish(self):
+        sql, self._sql = self._sql, None
+        if sql is None:
+            return
+        _record_query(sql, self._elapsed)
+        elapsed_ms = self._elapsed * 1000
+        if elapsed_ms >= SLOW_QUERY_MS:
+            logger.warning(
+                f"SLOW QUERY ({elapsed_ms:.1f} ms): {_normalize_sql(sql)}\n"
+                f"{_explain(self.connection, sql, self._params)}"
+            )
+
+class ProfilingConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = weakref.WeakSet()
+
+    def cursor(self, factory=ProfilingCursor):
+        cursor = super().cursor(factory)
+        self._cursors.add(cursor)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        # Record cursors that were never closed explicitly (the usual pattern here).
+        for cursor in list(self._cursors):
+            cursor._finish()
+        super().close()
+
+def _explain(conn, sql, params):
+    if params is None or not sql.lstrip().upper().startswith(("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")):
+        return "  (no query plan)"
+    try:
+        rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    except sqlite3.Error as e:
+        return f"  (EXPLAIN QUERY PLAN failed: {e})"
+    return "\n".join(f"  {detail}" for _, _, _, detail in rows)
+
+def _connect(db_path, read_only=False):
+    kwargs = {}
+    if read_only:
+        db_path = f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro"
+        kwargs["uri"] = True
+    if PROFILE_ENABLED:
+        kwargs["factory"] = ProfilingConnection
+    return sqlite3.connect(db_path, **kwargs)
+
+def enable_profiling(slow_query_ms=None):
+    global PROFILE_ENABLED, SLOW_QUERY_MS
+    PROFILE_ENABLED = True
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+
+def disable_profiling():
+    global PROFILE_ENABLED
+    PROFILE_ENABLED = False
+
+def reset_query_profile():
+    with _query_stats_lock:
+        _query_stats.clear()
+
+def get_query_profile():
+    """Aggregated timings per statement, slowest total first."""
+    with _query_stats_lock:
+        rows = [(sql, dict(stats)) for sql, stats in _query_stats.items()]
+    rows.sort(key=lambda row: row[1]["total"], reverse=True)
+    return rows
+
+def format_query_profile(limit=10):
+    rows = get_query_profile()[:limit]
+    if not rows:
+        return "No queries profiled yet."
+    lines = []
+    for sql, stats in rows:
+        avg_ms = stats["total"] / stats["calls"] * 1000
+        lines.append(
+            f"{stats['calls']}x total={stats['total'] * 1000:.1f}ms "
+            f"avg={avg_ms:.2f}ms max={stats['max'] * 1000:.1f}ms | {sql}"
+        )
+    return "\n".join(lines)
+
+def dump_query_profile(limit=10):
+    logger.info(f"Query profile:\n{format_query_profile(limit)}")
+
+def _migrate_base_tables(cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS db_version (
             key TEXT PRIMARY KEY,
             value TEXT
         )
     """)
-    
-    cursor.execute("SELECT value FROM db_version WHERE key = 'schema_version'")
-    version = cursor.fetchone()
-    
-    if version is None:
-        cursor.execute("INSERT INTO db_version (key, value) VALUES ('schema_version', '1')")
-        version = '1'
-    
-    if version[0] == '1':
-        try:
-            cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='participants'")
-            table_sql = cursor.fetchone()[0]
-            if 'PRIMARY KEY (user_id, chat_id)' in table_sql or ('user_id, chat_id' in table_sql and 'PRIMARY KEY' in table_sql):
-                logger.info("Detected old schema (user_id, chat_id) PK, migrating to new schema (user_id) PK...")
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS participants_new (
-                        user_id INTEGER PRIMARY KEY,
-                        mention_name TEXT,
-                        is_active BOOLEAN DEFAULT 1
-                    )
-                """)
-                cursor.execute("""
-                    INSERT OR IGNORE INTO participants_new (user_id, mention_name, is_active)
-                    SELECT user_id, mention_name, is_active FROM participants
-                """)
-                cursor.execute("DROP TABLE IF EXISTS participants")
-                cursor.execute("ALTER TABLE participants_new RENAME TO participants")
-                cursor.execute("UPDATE db_version SET value = '2' WHERE key = 'schema_version'")
-                logger.info("Migration to new schema completed successfully")
-        except Exception as e:
-            logger.error(f"Migration error: {e}")
-    
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS participants (
             user_id INTEGER PRIMARY KEY,
@@ -78,22 +226,375 @@ def init_db(db_path=None):
             PRIMARY KEY (user_id, chat_id, message_id)
         )
     """)
+
+def _migrate_participants_pk(cursor):
+    # Databases created before v2 keyed participants by (user_id, chat_id).
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='participants'")
+    table_sql = cursor.fetchone()[0]
+    if not ('PRIMARY KEY (user_id, chat_id)' in table_sql or ('user_id, chat_id' in table_sql and 'PRIMARY KEY' in table_sql)):
+        return
+    logger.info("Detected old schema (user_id, chat_id) PK, migrating to new schema (user_id) PK...")
+    cursor.execute("""
+        CREATE TABLE participants_new (
+            user_id INTEGER PRIMARY KEY,
+            mention_name TEXT,
+            is_active BOOLEAN DEFAULT 1
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO participants_new (user_id, mention_name, is_active)
+        SELECT user_id, mention_name, is_active FROM participants
+    """)
+    cursor.execute("DROP TABLE participants")
+    cursor.execute("ALTER TABLE participants_new RENAME TO participants")
+
+def _migrate_retention(cursor):
+    # Compacted all-time totals of events folded away by run_maintenance().
+    # event_count is the user's contribution to the `all` leaderboard, call_count the
+    # number of /smoke calls.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS smoke_totals (
+            chat_id INTEGER,
+            user_id INTEGER,
+            event_count INTEGER NOT NULL DEFAULT 0,
+            call_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_smoke_events_timestamp ON smoke_events (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_smoke_participation_timestamp ON smoke_participation (timestamp)")
+
+def _migrate_storage_mode(cursor):
+    # Freed pages are returned by run_maintenance() via incremental vacuum. Switching an
+    # existing file to incremental auto_vacuum only takes effect after a full VACUUM,
+    # and neither that nor the journal mode can change inside a transaction.
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        logger.info("Enabling incremental auto_vacuum (one-time VACUUM)...")
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    # WAL lets handlers keep reading while maintenance or an export is running.
+    cursor.execute("PRAGMA journal_mode = WAL")
+
+def _migrate_local_day(cursor):
+    # Local-day buckets are written at insert time so period filters are plain
+    # index range scans. Existing rows are bucketed in DEFAULT_TIMEZONE, using the
+    # zone's offset at the time of each row.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL
+        )
+    """)
+    _register_local_time_functions(cursor.connection)
+    for table in ("smoke_events", "smoke_participation"):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN local_day TEXT")
+        cursor.execute(f"UPDATE {table} SET local_day = local_day(timestamp, ?)", (DEFAULT_TIMEZONE,))
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table}_timestamp")
+        cursor.execute(f"CREATE INDEX idx_{table}_chat_day ON {table} (chat_id, local_day)")
+        cursor.execute(f"CREATE INDEX idx_{table}_local_day ON {table} (local_day)")
+
+def _local_time(timestamp, tz_name):
+    utc = datetime.datetime.fromisoformat(timestamp).replace(tzinfo=datetime.timezone.utc)
+    return utc.astimezone(get_zone(tz_name))
+
+def _local_day_of(timestamp, tz_name):
+    if timestamp is None:
+        return None
+    return _local_time(timestamp, tz_name).date().isoformat()
+
+def _local_slot_of(timestamp, tz_name):
+    # weekday * 24 + hour of the local time, weekday 0 is Monday.
+    if timestamp is None:
+        return None
+    local = _local_time(timestamp, tz_name)
+    return local.weekday() * 24 + local.hour
+
+def _register_local_time_functions(conn):
+    # A fixed SQLite date modifier is only right for the offset in force today; zones
+    # change offsets (DST, Asia/Almaty going from +6 to +5 in 2024), so backfills
+    # convert each stored UTC timestamp with zoneinfo instead.
+    conn.create_function("local_day", 2, _local_day_of, deterministic=True)
+    conn.create_function("local_slot", 2, _local_slot_of, deterministic=True)
+
+def _migrate_history_aggregates(cursor):
+    # Maintained incrementally by log_smoke_event / toggle_smoke_participation so
+    # /smoke_history never scans raw events. weekday is 0 for Monday.
+    cursor.execute("""
+        CREATE TABLE smoke_heatmap (
+            chat_id INTEGER,
+            weekday INTEGER,
+            hour INTEGER,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, weekday, hour)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE smoke_streaks (
+            chat_id INTEGER,
+            user_id INTEGER,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_day TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+
+    # Backfill from the raw events still on disk, each converted to its chat's timezone
+    # with the offset in force at the time.
+    _register_local_time_functions(cursor.connection)
+    cursor.execute("""
+        INSERT INTO smoke_heatmap (chat_id, weekday, hour, count)
+        SELECT chat_id, slot / 24, slot % 24, count(*)
+        FROM (
+            SELECT se.chat_id, local_slot(se.timestamp, COALESCE(cs.timezone, ?)) AS slot
+            FROM smoke_events se
+            LEFT JOIN chat_settings cs ON cs.chat_id = se.chat_id
+            WHERE se.timestamp IS NOT NULL
+        )
+        GROUP BY chat_id, slot
+    """, (DEFAULT_TIMEZONE,))
+
+    cursor.execute("""
+        SELECT chat_id, user_id, local_day FROM smoke_events WHERE local_day IS NOT NULL
+        UNION
+        SELECT chat_id, user_id, local_day FROM smoke_participation WHERE local_day IS NOT NULL
+        ORDER BY 1, 2, 3
+    """)
+    streaks = {}
+    # Iterated rather than fetched: the projection covers every raw event still on disk.
+    for chat_id, user_id, local_day in cursor:
+        day = datetime.date.fromisoformat(local_day)
+        streak = streaks.get((chat_id, user_id))
+        if streak is None:
+            streaks[(chat_id, user_id)] = [1, 1, day]
+            continue
+        streak[0] = streak[0] + 1 if day - streak[2] == datetime.timedelta(days=1) else 1
+        streak[1] = max(streak[1], streak[0])
+        streak[2] = day
+    cursor.executemany(
+        "INSERT INTO smoke_streaks (chat_id, user_id, current_streak, best_streak, last_day) VALUES (?, ?, ?, ?, ?)",
+        [(chat_id, user_id, current, best, day.isoformat()) for (chat_id, user_id), (current, best, day) in streaks.items()]
+    )
+
+# (version, migration, runs inside a transaction). Append only; never renumber.
+MIGRATIONS = [
+    (1, _migrate_base_tables, True),
+    (2, _migrate_participants_pk, True),
+    (3, _migrate_retention, True),
+    (4, _migrate_storage_mode, False),
+    (5, _migrate_local_day, True),
+    (6, _migrate_history_aggregates, True),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    try:
+        row = conn.execute("SELECT value FROM db_version WHERE key = 'schema_version'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+def init_db(db_path=None):
+    """Bring the schema up to SCHEMA_VERSION.
+
+    An up-to-date database costs a single version read. Otherwise each pending
+    migration runs once, in its own transaction together with the version bump.
+    """
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    try:
+        version = get_schema_version(conn)
+        if version >= SCHEMA_VERSION:
+            return
+        # Manage transactions explicitly: some migrations must run outside of one.
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        for target, migrate, transactional in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Applying schema migration {target} ({migrate.__name__})")
+            if transactional:
+                cursor.execute("BEGIN IMMEDIATE")
+            try:
+                migrate(cursor)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO db_version (key, value) VALUES ('schema_version', ?)",
+                    (str(target),)
+                )
+                if transactional:
+                    cursor.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    cursor.execute("ROLLBACK")
+                logger.error(f"Migration {target} failed: {e}")
+                raise
+    finally:
+        conn.close()
+
+def get_zone(tz_name):
+    return zoneinfo.ZoneInfo(tz_name)
+
+def is_valid_timezone(tz_name):
+    try:
+        get_zone(tz_name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+def _chat_timezone(cursor, chat_id, db_path):
+    key = (db_path, chat_id)
+    tz_name = _chat_timezones.get(key)
+    if tz_name is None:
+        cursor.execute("SELECT timezone FROM chat_settings WHERE chat_id = ?", (chat_id,))
+        row = cursor.fetchone()
+        tz_name = _chat_timezones[key] = row[0] if row else DEFAULT_TIMEZONE
+    return tz_name
+
+def _now_and_local(cursor, chat_id, db_path, now=None):
+    """UTC timestamp and the chat's local time, both taken from the same instant."""
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    local = now.astimezone(get_zone(_chat_timezone(cursor, chat_id, db_path)))
+    return now.strftime("%Y-%m-%d %H:%M:%S"), local
+
+def _record_heatmap(cursor, chat_id, local):
+    cursor.execute("""
+        INSERT INTO smoke_heatmap (chat_id, weekday, hour, count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (chat_id, weekday, hour) DO UPDATE SET count = count + 1
+    """, (chat_id, local.weekday(), local.hour))
+
+def _record_streak(cursor, chat_id, user_id, local_day):
+    """Extend the user's streak of consecutive local days with a smoke."""
+    yesterday = (datetime.date.fromisoformat(local_day) - datetime.timedelta(days=1)).isoformat()
+    # In an upsert, column names refer to the row before the update.
+    streak = "CASE WHEN last_day >= excluded.last_day THEN current_streak WHEN last_day = ? THEN current_streak + 1 ELSE 1 END"
+    cursor.execute(f"""
+        INSERT INTO smoke_streaks (chat_id, user_id, current_streak, best_streak, last_day) VALUES (?, ?, 1, 1, ?)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            current_streak = {streak},
+            best_streak = max(best_streak, {streak}),
+            last_day = max(last_day, excluded.last_day)
+    """, (chat_id, user_id, local_day, yesterday, yesterday))
+
+def _period_start_day(cursor, chat_id, period, db_path):
+    """First local day of `period` for the chat, None for all time."""
+    if period == 'all':
+        return None
+    days = PERIOD_DAYS.get(period, PERIOD_DAYS['week'])
+    today = datetime.datetime.now(get_zone(_chat_timezone(cursor, chat_id, db_path))).date()
+    return (today - datetime.timedelta(days=days - 1)).isoformat()
+
+def get_chat_timezone(chat_id, db_path=None):
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    try:
+        return _chat_timezone(conn.cursor(), chat_id, db_path)
+    finally:
+        conn.close()
+
+def set_chat_timezone(chat_id, tz_name, db_path=None):
+    """Set the chat's IANA timezone. Only rows written afterwards use the new zone."""
+    if db_path is None:
+        db_path = DB_PATH
+    if not is_valid_timezone(tz_name):
+        raise ValueError(f"Unknown timezone: {tz_name}")
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO chat_settings (chat_id, timezone) VALUES (?, ?)",
+        (chat_id, tz_name)
+    )
     conn.commit()
     conn.close()
+    _chat_timezones[(db_path, chat_id)] = tz_name
+
+def _insert_smoke_event(cursor, chat_id, user_id, db_path, now=None):
+    timestamp, local = _now_and_local(cursor, chat_id, db_path, now)
+    local_day = local.date().isoformat()
+    cursor.execute(
+        "INSERT INTO smoke_events (chat_id, user_id, timestamp, local_day) VALUES (?, ?, ?, ?)",
+        (chat_id, user_id, timestamp, local_day)
+    )
+    _record_heatmap(cursor, chat_id, local)
+    _record_streak(cursor, chat_id, user_id, local_day)
+
+def _insert_participation(cursor, user_id, chat_id, message_id, db_path, now=None):
+    timestamp, local = _now_and_local(cursor, chat_id, db_path, now)
+    local_day = local.date().isoformat()
+    cursor.execute(
+        "INSERT OR IGNORE INTO smoke_participation (user_id, chat_id, message_id, timestamp, local_day) VALUES (?, ?, ?, ?, ?)",
+        (user_id, chat_id, message_id, timestamp, local_day)
+    )
+    if cursor.rowcount:
+        # Leaving again later does not shorten the streak.
+        _record_streak(cursor, chat_id, user_id, local_day)
+
+def _delete_participation(cursor, user_id, chat_id, message_id):
+    cursor.execute(
+        "DELETE FROM smoke_participation WHERE user_id = ? AND chat_id = ? AND message_id = ?",
+        (user_id, chat_id, message_id)
+    )
 
 def log_smoke_event(chat_id, user_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO smoke_events (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
+    _insert_smoke_event(cursor, chat_id, user_id, db_path)
     conn.commit()
     conn.close()
 
+def is_participating(user_id, chat_id, message_id, db_path=None):
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT 1 FROM smoke_participation WHERE user_id = ? AND chat_id = ? AND message_id = ?",
+        (user_id, chat_id, message_id)
+    )
+    exists = cursor.fetchone()
+    conn.close()
+    return exists is not None
+
+def apply_write_batch(ops, db_path=None):
+    """Apply queued writes in a single transaction (one fsync for the whole batch).
+
+    ops are ('event', chat_id, user_id, when) or
+    ('rsvp', user_id, chat_id, message_id, joined, when), where `when` is the aware
+    UTC datetime the write was accepted. RSVP ops carry the target state rather than
+    a toggle, so re-applying a batch after a failure is harmless.
+    """
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for op in ops:
+            if op[0] == 'event':
+                _, chat_id, user_id, when = op
+                _insert_smoke_event(cursor, chat_id, user_id, db_path, when)
+            else:
+                _, user_id, chat_id, message_id, joined, when = op
+                if joined:
+                    _insert_participation(cursor, user_id, chat_id, message_id, db_path, when)
+                else:
+                    _delete_participation(cursor, user_id, chat_id, message_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 def toggle_smoke_participation(user_id, chat_id, message_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     
     # Check if exists
@@ -104,16 +605,10 @@ def toggle_smoke_participation(user_id, chat_id, message_id, db_path=None):
     exists = cursor.fetchone()
     
     if exists:
-        cursor.execute(
-            "DELETE FROM smoke_participation WHERE user_id = ? AND chat_id = ? AND message_id = ?",
-            (user_id, chat_id, message_id)
-        )
+        _delete_participation(cursor, user_id, chat_id, message_id)
         joined = False
     else:
-        cursor.execute(
-            "INSERT INTO smoke_participation (user_id, chat_id, message_id) VALUES (?, ?, ?)",
-            (user_id, chat_id, message_id)
-        )
+        _insert_participation(cursor, user_id, chat_id, message_id, db_path)
         joined = True
         
     conn.commit()
@@ -123,19 +618,21 @@ def toggle_smoke_participation(user_id, chat_id, message_id, db_path=None):
 def get_smoke_leaderboard(chat_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
+    today = _period_start_day(cursor, chat_id, 'today', db_path)
+    week_start = _period_start_day(cursor, chat_id, 'week', db_path)
     
     # Today
     cursor.execute("""
         SELECT p.mention_name, count(*) as count 
         FROM smoke_participation sp
         JOIN participants p ON sp.user_id = p.user_id
-        WHERE sp.chat_id = ? AND date(sp.timestamp) = date('now')
+        WHERE sp.chat_id = ? AND sp.local_day = ?
         GROUP BY sp.user_id
-        ORDER BY count DESC
+        ORDER BY count DESC, sp.user_id
         LIMIT 5
-    """, (chat_id,))
+    """, (chat_id, today))
     today_stats = cursor.fetchall()
     
     # Week
@@ -143,11 +640,11 @@ def get_smoke_leaderboard(chat_id, db_path=None):
         SELECT p.mention_name, count(*) as count 
         FROM smoke_participation sp
         JOIN participants p ON sp.user_id = p.user_id
-        WHERE sp.chat_id = ? AND sp.timestamp >= datetime('now', '-7 days')
+        WHERE sp.chat_id = ? AND sp.local_day >= ?
         GROUP BY sp.user_id
-        ORDER BY count DESC
+        ORDER BY count DESC, sp.user_id
         LIMIT 5
-    """, (chat_id,))
+    """, (chat_id, week_start))
     week_stats = cursor.fetchall()
     
     conn.close()
@@ -156,24 +653,20 @@ def get_smoke_leaderboard(chat_id, db_path=None):
 def get_smoke_stats(chat_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     
-    # Count for today (local time might be tricky with SQLite default UTC, but let's assume 'start of day' in UTC or just last 24h? 
-    # 'start of day' is better for "today". SQLite 'now' is UTC.
-    # Let's use 'localtime' modifier if we want server local time, or just UTC. 
-    # Simple approach: date('now') matches YYYY-MM-DD.
-    
+    # Days are the chat's local days (see /smoke_timezone), bucketed at insert time.
     cursor.execute("""
         SELECT count(*) FROM smoke_events 
-        WHERE chat_id = ? AND date(timestamp) = date('now')
-    """, (chat_id,))
+        WHERE chat_id = ? AND local_day = ?
+    """, (chat_id, _period_start_day(cursor, chat_id, 'today', db_path)))
     today_count = cursor.fetchone()[0]
     
     cursor.execute("""
         SELECT count(*) FROM smoke_events 
-        WHERE chat_id = ? AND timestamp >= datetime('now', '-7 days')
-    """, (chat_id,))
+        WHERE chat_id = ? AND local_day >= ?
+    """, (chat_id, _period_start_day(cursor, chat_id, 'week', db_path)))
     week_count = cursor.fetchone()[0]
     
     conn.close()
@@ -182,7 +675,7 @@ def get_smoke_stats(chat_id, db_path=None):
 def add_or_update_user(user_id, mention_name, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT is_active FROM participants WHERE user_id = ?", (user_id,))
@@ -208,7 +701,7 @@ def add_or_update_user(user_id, mention_name, db_path=None):
 def set_user_active(user_id, is_active, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     cursor.execute(
         "UPDATE participants SET is_active = ? WHERE user_id = ?",
@@ -220,7 +713,7 @@ def set_user_active(user_id, is_active, db_path=None):
 def is_user_active(user_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT is_active FROM participants WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
@@ -230,45 +723,78 @@ def is_user_active(user_id, db_path=None):
 def get_active_users(db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, mention_name FROM participants WHERE is_active = 1")
     users = cursor.fetchall()
     conn.close()
     return users
 
+def get_smoke_history(chat_id, limit=5, db_path=None):
+    """Hour x weekday heatmap of /smoke calls and the chat's top streaks.
+
+    Returns (heatmap, streaks): heatmap[weekday][hour] counts calls in the chat's local
+    time (weekday 0 is Monday); streaks are (mention_name, current_streak, best_streak)
+    ordered by best streak. A current streak that missed yesterday counts as 0.
+    """
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+
+    heatmap = [[0] * 24 for _ in range(7)]
+    cursor.execute("SELECT weekday, hour, count FROM smoke_heatmap WHERE chat_id = ?", (chat_id,))
+    for weekday, hour, count in cursor.fetchall():
+        heatmap[weekday][hour] = count
+
+    today = datetime.date.fromisoformat(_period_start_day(cursor, chat_id, 'today', db_path))
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    cursor.execute("""
+        SELECT p.mention_name, CASE WHEN s.last_day >= ? THEN s.current_streak ELSE 0 END, s.best_streak
+        FROM smoke_streaks s
+        JOIN participants p ON s.user_id = p.user_id
+        WHERE s.chat_id = ?
+        ORDER BY s.best_streak DESC, 2 DESC, s.user_id
+        LIMIT ?
+    """, (yesterday, chat_id, limit))
+    streaks = cursor.fetchall()
+
+    conn.close()
+    return heatmap, streaks
+
 def get_monthly_stats(chat_id, db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
+    month_start = _period_start_day(cursor, chat_id, 'month', db_path)
     
     cursor.execute("""
         SELECT count(*) FROM smoke_events 
-        WHERE chat_id = ? AND timestamp >= datetime('now', '-30 days')
-    """, (chat_id,))
+        WHERE chat_id = ? AND local_day >= ?
+    """, (chat_id, month_start))
     month_count = cursor.fetchone()[0]
     
     cursor.execute("""
         SELECT p.mention_name, count(*) as count 
         FROM smoke_events se
         JOIN participants p ON se.user_id = p.user_id
-        WHERE se.chat_id = ? AND se.timestamp >= datetime('now', '-30 days')
+        WHERE se.chat_id = ? AND se.local_day >= ?
         GROUP BY se.user_id
-        ORDER BY count DESC
+        ORDER BY count DESC, se.user_id
         LIMIT 1
-    """, (chat_id,))
+    """, (chat_id, month_start))
     top_smoker = cursor.fetchone()
     
     cursor.execute("""
         SELECT p.mention_name, count(*) as count 
         FROM smoke_participation sp
         JOIN participants p ON sp.user_id = p.user_id
-        WHERE sp.chat_id = ? AND sp.timestamp >= datetime('now', '-30 days')
+        WHERE sp.chat_id = ? AND sp.local_day >= ?
         GROUP BY sp.user_id
-        ORDER BY count DESC
+        ORDER BY count DESC, sp.user_id
         LIMIT 5
-    """, (chat_id,))
+    """, (chat_id, month_start))
     month_leaders = cursor.fetchall()
     
     conn.close()
@@ -290,16 +816,29 @@ def get_smoke_leaderboard_for_period(chat_id, period='week', limit=10, db_path=N
     """
     if db_path is None:
         db_path = DB_PATH
-    conn = sqlite3.connect(db_path)
+    conn = _connect(db_path)
     cursor = conn.cursor()
+    leaders = [(name, count) for _, name, count in _ranked_leaderboard(cursor, chat_id, period, limit, db_path)]
+    conn.close()
+    return leaders
 
-    period_map = {
-        'today': "date(timestamp) = date('now')",
-        'week': "timestamp >= datetime('now', '-7 days')",
-        'month': "timestamp >= datetime('now', '-30 days')",
-        'all': "1=1"
-    }
-    condition = period_map.get(period, period_map['week'])
+def get_leaderboard_ranking(chat_id, period='week', db_path=None):
+    """The whole ranking behind get_smoke_leaderboard_for_period() as (user_id, mention_name, count)."""
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+    # LIMIT -1 means no limit in SQLite.
+    ranking = _ranked_leaderboard(cursor, chat_id, period, -1, db_path)
+    conn.close()
+    return ranking
+
+def _ranked_leaderboard(cursor, chat_id, period, limit, db_path):
+    # Periods are ranges of the chat's local days; every day is >= '' for all time.
+    start_day = _period_start_day(cursor, chat_id, period, db_path) or ''
+
+    # Rows folded by run_maintenance() are older than any windowed period.
+    totals_condition = "1=1" if period == 'all' else "0=1"
 
     # We count unique user-event pairs.
     # RSVP joins are keyed by (user_id, message_id).
@@ -309,37 +848,176 @@ def get_smoke_leaderboard_for_period(chat_id, period='week', limit=10, db_path=N
         WITH rsvp AS (
             SELECT sp.user_id as user_id, 'm:' || sp.message_id as event_key
             FROM smoke_participation sp
-            WHERE sp.chat_id = ? AND {condition.replace('timestamp', 'sp.timestamp')}
+            WHERE sp.chat_id = ? AND sp.local_day >= ?
         ),
         calls AS (
             SELECT se.user_id as user_id, 'c:' || se.id as event_key
             FROM smoke_events se
-            WHERE se.chat_id = ? AND {condition.replace('timestamp', 'se.timestamp')} AND NOT EXISTS (
+            WHERE se.chat_id = ? AND se.local_day >= ? AND NOT EXISTS (
                 SELECT 1
                 FROM smoke_participation sp
                 WHERE sp.chat_id = se.chat_id
+                  AND sp.local_day = se.local_day
                   AND sp.user_id = se.user_id
-                  AND date(sp.timestamp) = date(se.timestamp)
             )
         ),
         unioned AS (
             SELECT user_id, event_key FROM rsvp
             UNION
             SELECT user_id, event_key FROM calls
+        ),
+        counted AS (
+            SELECT user_id, count(*) as count FROM unioned GROUP BY user_id
+            UNION ALL
+            SELECT user_id, event_count FROM smoke_totals WHERE chat_id = ? AND {totals_condition}
         )
-        SELECT p.mention_name, count(*) as count
-        FROM unioned u
-        JOIN participants p ON u.user_id = p.user_id
-        GROUP BY u.user_id
-        ORDER BY count DESC
+        SELECT c.user_id, p.mention_name, sum(c.count) as count
+        FROM counted c
+        JOIN participants p ON c.user_id = p.user_id
+        GROUP BY c.user_id
+        ORDER BY count DESC, c.user_id
         LIMIT ?
-    """, (chat_id, chat_id, limit))
+    """, (chat_id, start_day, chat_id, start_day, chat_id, limit))
+    return cursor.fetchall()
 
-    leaders = cursor.fetchall()
-    conn.close()
-    return leaders
+def _oldest_day_before(cursor, cutoff_day):
+    cursor.execute("""
+        SELECT min(day) FROM (
+            SELECT min(local_day) as day FROM smoke_events WHERE local_day < ?
+            UNION ALL
+            SELECT min(local_day) as day FROM smoke_participation WHERE local_day < ?
+        )
+    """, (cutoff_day, cutoff_day))
+    return cursor.fetchone()[0]
+
+def _fold_day(cursor, day):
+    """Fold one local day of raw rows into smoke_totals and delete them.
+
+    Whole days are folded at once because the leaderboard matches /smoke calls to
+    RSVPs of the same day; both sides of every match are therefore removed together,
+    which keeps the `all` leaderboard unchanged.
+    """
+    cursor.execute("""
+        INSERT INTO smoke_totals (chat_id, user_id, event_count)
+        SELECT chat_id, user_id, count(*)
+        FROM smoke_participation
+        WHERE local_day = ?
+        GROUP BY chat_id, user_id
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET event_count = event_count + excluded.event_count
+    """, (day,))
+    cursor.execute("""
+        INSERT INTO smoke_totals (chat_id, user_id, event_count, call_count)
+        SELECT se.chat_id, se.user_id, sum(NOT EXISTS (
+            SELECT 1
+            FROM smoke_participation sp
+            WHERE sp.chat_id = se.chat_id
+              AND sp.local_day = se.local_day
+              AND sp.user_id = se.user_id
+        )), count(*)
+        FROM smoke_events se
+        WHERE se.local_day = ?
+        GROUP BY se.chat_id, se.user_id
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            event_count = event_count + excluded.event_count,
+            call_count = call_count + excluded.call_count
+    """, (day,))
+
+    cursor.execute("DELETE FROM smoke_events WHERE local_day = ?", (day,))
+    events_deleted = cursor.rowcount
+    cursor.execute("DELETE FROM smoke_participation WHERE local_day = ?", (day,))
+    return events_deleted, cursor.rowcount
+
+def run_maintenance(retention_days=None, pause=0.05, db_path=None):
+    """Compact old raw events and give the freed pages back to the filesystem.
+
+    Each day is folded in its own short transaction with a pause in between, so bot
+    handlers are never locked out for longer than a single day's batch. Meant to be
+    run off the event loop (see the maintenance job in main.py).
+    """
+    if db_path is None:
+        db_path = DB_PATH
+    if retention_days is None:
+        retention_days = RETENTION_DAYS
+    if retention_days < MIN_RETENTION_DAYS:
+        logger.warning(f"RETENTION_DAYS={retention_days} is below {MIN_RETENTION_DAYS}, using {MIN_RETENTION_DAYS}")
+        retention_days = MIN_RETENTION_DAYS
+
+    cutoff_day = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=retention_days)).isoformat()
+    stats = {"days_folded": 0, "events_deleted": 0, "participation_deleted": 0, "pages_freed": 0}
+
+    conn = _connect(db_path)
+    cursor = conn.cursor()
+    try:
+        while True:
+            day = _oldest_day_before(cursor, cutoff_day)
+            if day is None:
+                break
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                events_deleted, participation_deleted = _fold_day(cursor, day)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            stats["days_folded"] += 1
+            stats["events_deleted"] += events_deleted
+            stats["participation_deleted"] += participation_deleted
+            time.sleep(pause)
+
+        cursor.execute("PRAGMA page_count")
+        pages_before = cursor.fetchone()[0]
+        while True:
+            cursor.execute("PRAGMA freelist_count")
+            if cursor.fetchone()[0] == 0:
+                break
+            cursor.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+            time.sleep(pause)
+        cursor.execute("PRAGMA page_count")
+        stats["pages_freed"] = pages_before - cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+    if stats["days_folded"]:
+        logger.info(
+            f"Maintenance folded {stats['days_folded']} day(s) before {cutoff_day}: "
+            f"{stats['events_deleted']} events, {stats['participation_deleted']} RSVPs removed, "
+            f"{stats['pages_freed']} pages freed"
+        )
+    return stats
+
+HISTORY_COLUMNS = ("kind", "chat_id", "user_id", "message_id", "event_id", "timestamp", "local_day")
+# Both follow the (chat_id, local_day) indexes, so rows stream without a sort.
+HISTORY_QUERIES = (
+    "SELECT 'call', chat_id, user_id, NULL, id, timestamp, local_day FROM smoke_events WHERE chat_id = ? ORDER BY local_day, id",
+    "SELECT 'rsvp', chat_id, user_id, message_id, NULL, timestamp, local_day FROM smoke_participation WHERE chat_id = ?",
+)
+
+def iter_chat_history(chat_id, chunk_size=1000, db_path=None):
+    """Yield a chat's raw smoke_events and smoke_participation rows in chunks.
+
+    Rows follow HISTORY_COLUMNS; kind is 'call' for /smoke calls, ordered by local day and
+    id, and 'rsvp' for joins.
+    Both tables are read from one read-only snapshot and fetched chunk by chunk, so
+    memory stays constant and, with WAL, writers are never blocked. Events already
+    folded by run_maintenance() are not included.
+    """
+    if db_path is None:
+        db_path = DB_PATH
+    conn = _connect(db_path, read_only=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        for query in HISTORY_QUERIES:
+            cursor.execute(query, (chat_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        conn.close()
 
 def get_db_connection(db_path=None):
     if db_path is None:
         db_path = DB_PATH
-    return sqlite3.connect(db_path)
+    return _connect(db_path)
@@ -0,0 +1,58 @@
+import argparse
+import csv
+import gzip
+import json
+import sys
+import database
+import storage
+
+FORMATS = ("csv", "jsonl")
+
+def write_history(store, chat_id, out, fmt="csv"):
+    """Stream a chat's history to a text file object, returns the number of rows."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    count = 0
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(database.HISTORY_COLUMNS)
+
+    for rows in store.iter_chat_history(chat_id):
+        if writer is not None:
+            writer.writerows(rows)
+        else:
+            out.writelines(
+                json.dumps(dict(zip(database.HISTORY_COLUMNS, row)), ensure_ascii=False) + "\n"
+                for row in rows
+            )
+        count += len(rows)
+    return count
+
+def export_history(store, chat_id, path, fmt="csv"):
+    """Export to `path`, gzip-compressed when it ends with .gz."""
+    if path.endswith(".gz"):
+        out = gzip.open(path, "wt", encoding="utf-8", newline="")
+    else:
+        out = open(path, "w", encoding="utf-8", newline="")
+    with out:
+        return write_history(store, chat_id, out, fmt)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a chat's smoke history as CSV or JSON Lines.")
+    parser.add_argument("chat_id", type=int)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("-o", "--output", default="-", help="output file, '-' for stdout, *.gz to compress")
+    parser.add_argument("--db", default=None, help="database path (defaults to DB_PATH)")
+    args = parser.parse_args(argv)
+
+    store = storage.SQLiteStorage(args.db)
+    if args.output == "-":
+        count = write_history(store, args.chat_id, sys.stdout, args.format)
+    else:
+        count = export_history(store, args.chat_id, args.output, args.format)
+    print(f"Exported {count} rows", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
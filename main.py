@@ -1,11 +1,22 @@
+import asyncio
 import logging
 import os
 import random
 import datetime
+import html
+import tempfile
+import time
 import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from dotenv import load_dotenv
+
+# database and storage read their settings from the environment when imported.
+load_dotenv()
+
 import database
+import export
+import storage
 
 class TelegramLogFilter(logging.Filter):
     def filter(self, record):
@@ -30,6 +41,17 @@ def log_action(action: str, details: str = ""):
 
 BOT_USERNAME = None
 
+# Telegram user ids allowed to run maintenance commands, comma-separated.
+ADMIN_IDS = {int(uid) for uid in os.getenv("ADMIN_IDS", "").split(",") if uid.strip()}
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+# Created in main(), so importing this module does not start the write-behind thread.
+store = None
+
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+
 WEATHER_API_URL = "http://api.weatherapi.com/v1/current.json?key=3d10f31522e649a9803151553240411&q=Almaty&aqi=no"
 OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast?latitude=43.25&longitude=76.9167&daily=weather_code,temperature_2m_max,temperature_2m_min,sunset,sunrise,rain_sum,snowfall_sum&current=temperature_2m&timezone=auto&forecast_days=1"
 
@@ -67,6 +89,15 @@ WMO_WEATHER_CODES = {
 
 TRACKED_CHATS = set()
 
+# Open-Meteo is re-queried at most once per WEATHER_CACHE_SECONDS across all chats.
+WEATHER_CACHE_SECONDS = float(os.getenv("WEATHER_CACHE_SECONDS", "300"))
+# After a failed request Open-Meteo is left alone this long; the last good forecast is served meanwhile.
+WEATHER_RETRY_SECONDS = float(os.getenv("WEATHER_RETRY_SECONDS", "60"))
+# Callback queries must be answered quickly; slower refreshes are answered first and finished after.
+WEATHER_ANSWER_TIMEOUT = 2.0
+_weather_cache = {"text": None, "fetched_at": 0.0, "failed_at": None}
+_weather_refresh = None
+
 SMOKE_MESSAGES = [
     "🚬 ГО КУРИТЬ! 🚬\n{mentions}\n\nНу че, народ, погнали дымить? 😮‍💨",
     "🔥 ВРЕМЯ ПЫХНУТЬ! 🔥\n{mentions}\n\nКто не курит, тот работает (или нет). Го на улицу! 🚶‍♂️",
@@ -156,6 +187,39 @@ async def get_open_meteo_weather():
         logging.error(f"Error fetching Open-Meteo weather: {e}")
     return None
 
+async def _refresh_weather_cache():
+    global _weather_refresh
+    try:
+        weather_text = await get_open_meteo_weather()
+        if weather_text:
+            _weather_cache["text"] = weather_text
+            _weather_cache["fetched_at"] = time.monotonic()
+            _weather_cache["failed_at"] = None
+        else:
+            _weather_cache["failed_at"] = time.monotonic()
+        # Serve the last good forecast if the API is down.
+        return _weather_cache["text"]
+    finally:
+        _weather_refresh = None
+
+async def get_cached_weather():
+    """Weather text from the shared cache, refreshed when older than WEATHER_CACHE_SECONDS.
+
+    Callers that find the cache stale at the same time all await a single upstream request.
+    After a failure no request is made for WEATHER_RETRY_SECONDS.
+    """
+    global _weather_refresh
+    now = time.monotonic()
+    if _weather_cache["text"] is not None and now - _weather_cache["fetched_at"] < WEATHER_CACHE_SECONDS:
+        return _weather_cache["text"]
+    failed_at = _weather_cache["failed_at"]
+    if failed_at is not None and now - failed_at < WEATHER_RETRY_SECONDS:
+        return _weather_cache["text"]
+    if _weather_refresh is None:
+        _weather_refresh = asyncio.create_task(_refresh_weather_cache())
+    # Shielded so one cancelled waiter does not cancel the request for everybody else.
+    return await asyncio.shield(_weather_refresh)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
@@ -181,7 +245,7 @@ async def capture_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         update.effective_chat.get_administrators
         
         if chat.type in ['group', 'supergroup']:
-            database.add_or_update_user(
+            store.add_or_update_user(
                 user.id, 
                 user.mention_html()
             )
@@ -200,11 +264,11 @@ async def smoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admins = await context.bot.get_chat_administrators(chat_id)
         for admin in admins:
             if not admin.user.is_bot:
-                database.add_or_update_user(admin.user.id, admin.user.mention_html())
+                store.add_or_update_user(admin.user.id, admin.user.mention_html())
     except Exception as e:
         logging.error(f"Error fetching admins: {e}")
 
-    users = database.get_active_users()
+    users = store.get_active_users()
     mentions = [name for uid, name in users if uid != caller_id]
 
     if not mentions:
@@ -212,7 +276,7 @@ async def smoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эй, тут пусто! Либо ты один, либо все ливнули. 🗿")
         return
 
-    database.log_smoke_event(chat_id, caller_id)
+    store.log_smoke_event(chat_id, caller_id)
     log_action("SMOKE_LOGGED", f"Smoke event logged for user {caller_id} in chat {chat_id}")
 
     mentions_str = " ".join(mentions)
@@ -233,7 +297,7 @@ async def smoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
     actual_message_id = sent_message.message_id
 
     # Auto-join caller and then update the single button.
-    database.toggle_smoke_participation(caller_id, chat_id, actual_message_id)
+    store.toggle_smoke_participation(caller_id, chat_id, actual_message_id)
     log_action("SMOKE_AUTO_JOIN", f"Caller {caller_id} ({caller_name}) automatically joined smoke event")
 
     updated_reply_markup = InlineKeyboardMarkup(
@@ -253,7 +317,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = query.message.chat_id
     message_id = int(query.data.split("_")[1])
 
-    joined = database.toggle_smoke_participation(user.id, chat_id, message_id)
+    joined = store.toggle_smoke_participation(user.id, chat_id, message_id)
     status = "joined" if joined else "left"
     log_action("BUTTON_CLICK", f"User {user.id} ({user.first_name}) {status} smoke event in chat {chat_id}")
 
@@ -309,9 +373,9 @@ async def smoke_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_action("STATS_COMMAND", f"User {user.id} ({user.first_name}) requested stats in chat {chat_id}")
     await capture_user(update, context)
     
-    today, week = database.get_smoke_stats(chat_id)
-    today_leaders, week_leaders = database.get_smoke_leaderboard(chat_id)
-    month_count, top_smoker, month_leaders = database.get_monthly_stats(chat_id)
+    today, week = store.get_smoke_stats(chat_id)
+    today_leaders, week_leaders = store.get_smoke_leaderboard(chat_id)
+    month_count, top_smoker, month_leaders = store.get_monthly_stats(chat_id)
     
     def format_leaders(leaders):
         if not leaders:
@@ -336,6 +400,53 @@ async def smoke_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_html(text)
 
+WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+HEATMAP_SHADES = " ░▒▓█"
+
+def format_heatmap(heatmap):
+    peak = max(max(row) for row in heatmap)
+    lines = ["   0     6     12    18"]
+    for name, row in zip(WEEKDAY_NAMES, heatmap):
+        cells = "".join(
+            HEATMAP_SHADES[0] if not count else HEATMAP_SHADES[1 + (count * 4 - 1) // peak]
+            for count in row
+        )
+        lines.append(f"{name} {cells}")
+    return "\n".join(lines)
+
+async def smoke_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    log_action("HISTORY_COMMAND", f"User {user.id} ({user.first_name}) requested history in chat {chat_id}")
+    await capture_user(update, context)
+
+    heatmap, streaks = store.get_smoke_history(chat_id)
+    slots = sorted(
+        ((count, weekday, hour) for weekday, row in enumerate(heatmap) for hour, count in enumerate(row) if count),
+        reverse=True
+    )[:3]
+
+    if not slots:
+        await update.message.reply_html("📜 Истории пока нет. Юзай /smoke, чтобы начать! 🚬")
+        return
+
+    slot_lines = "\n".join(
+        f"{i}. {WEEKDAY_NAMES[weekday]} {hour:02d}:00 — <b>{count}</b>"
+        for i, (count, weekday, hour) in enumerate(slots, start=1)
+    )
+    streak_lines = "\n".join(
+        f"{i}. {name}: 🔥 <b>{current}</b> (рекорд {best})"
+        for i, (name, current, best) in enumerate(streaks, start=1)
+    ) or "Пока никто..."
+
+    text = (
+        f"📜 <b>История перекуров</b> ({html.escape(store.get_chat_timezone(chat_id))})\n\n"
+        f"<pre>{format_heatmap(heatmap)}</pre>\n"
+        f"⏰ <b>Самые дымные слоты:</b>\n{slot_lines}\n\n"
+        f"📅 <b>Серии дней подряд:</b>\n{streak_lines}"
+    )
+    await update.message.reply_html(text)
+
 async def smoke_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat_id = update.effective_chat.id
@@ -343,11 +454,11 @@ async def smoke_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await capture_user(update, context)
     
-    if not database.is_user_active(user.id):
+    if not store.is_user_active(user.id):
         await update.message.reply_html(f"Ты и так не в рассылке")
         return
     
-    database.set_user_active(user.id, False)
+    store.set_user_active(user.id, False)
     await update.message.reply_html(f"Ок, {user.first_name}, не душни, убрал тебя. 🫡")
 
 async def smoke_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -357,11 +468,11 @@ async def smoke_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await capture_user(update, context)
     
-    if database.is_user_active(user.id):
+    if store.is_user_active(user.id):
         await update.message.reply_html(f"Ты и так в рассылке")
         return
     
-    database.set_user_active(user.id, True)
+    store.set_user_active(user.id, True)
     await update.message.reply_html(f"Опа, {user.first_name} снова с нами! Велкам бэк. 😎")
 
 async def weather_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -369,7 +480,7 @@ async def weather_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     log_action("WEATHER_INFO", f"User {user.id} ({user.first_name}) requested weather in chat {chat_id}")
     
-    weather_text = await get_open_meteo_weather()
+    weather_text = await get_cached_weather()
     
     if weather_text:
         keyboard = [[InlineKeyboardButton("Обновить 🔄", callback_data="refresh_weather")]]
@@ -378,11 +489,39 @@ async def weather_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_html("Не удалось получить погоду. Попробуй позже. 😔")
 
+async def refresh_weather_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = query.from_user
+    log_action("WEATHER_REFRESH", f"User {user.id} ({user.first_name}) refreshed weather in chat {query.message.chat_id}")
+
+    refresh = asyncio.ensure_future(get_cached_weather())
+    answered = False
+    try:
+        weather_text = await asyncio.wait_for(asyncio.shield(refresh), WEATHER_ANSWER_TIMEOUT)
+    except asyncio.TimeoutError:
+        await query.answer("Обновляю погоду... ⏳")
+        answered = True
+        weather_text = await refresh
+
+    if not weather_text:
+        if not answered:
+            await query.answer("Не удалось получить погоду. Попробуй позже. 😔")
+        return
+    # Editing a message to identical text is a wasted (and rejected) API call.
+    if weather_text == query.message.text_html:
+        if not answered:
+            await query.answer("Погода уже свежая ✅")
+        return
+
+    if not answered:
+        await query.answer()
+    await query.edit_message_text(weather_text, parse_mode="HTML", reply_markup=query.message.reply_markup)
+
 async def send_daily_weather(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
     log_action("DAILY_WEATHER", f"Sending daily weather to chat {chat_id}")
 
-    weather_text = await get_open_meteo_weather()
+    weather_text = await get_cached_weather()
 
     if weather_text:
         try:
@@ -396,13 +535,21 @@ def schedule_daily_weather(application, chat_id):
     job_queue = application.job_queue
     job_queue.run_daily(
         send_daily_weather,
-        time=datetime.time(hour=9, minute=0, tzinfo=datetime.timezone(datetime.timedelta(hours=6))),
+        time=datetime.time(hour=9, minute=0, tzinfo=database.get_zone(store.get_chat_timezone(chat_id))),
         days=(0, 1, 2, 3, 4),
         chat_id=chat_id,
         name=f"daily_weather_{chat_id}"
     )
     log_action("SCHEDULE_WEATHER", f"Scheduled daily weather for chat {chat_id} at 9:00 AM")
 
+async def run_db_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    # Runs in a worker thread so handlers keep being served while old events are folded.
+    try:
+        stats = await asyncio.to_thread(store.run_maintenance)
+        log_action("DB_MAINTENANCE", f"{stats}")
+    except Exception as e:
+        log_action("DB_MAINTENANCE_ERROR", f"{e}")
+
 async def weather_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user = update.effective_user
@@ -421,24 +568,100 @@ async def weather_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log_action("WEATHER_SUBSCRIBE", f"User {user.id} subscribed to daily weather in chat {chat_id}")
         await update.message.reply_html("✅ Ежедневная погода включена! Каждый будний день в 9:00 утра я буду присылать сводку. ☀️")
 
+async def smoke_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+
+    if not context.args:
+        await update.message.reply_html(
+            f"🕰️ Часовой пояс чата: <b>{store.get_chat_timezone(chat_id)}</b>\n"
+            f"Сменить: <code>/smoke_timezone Asia/Almaty</code>"
+        )
+        return
+
+    if update.effective_chat.type in ['group', 'supergroup'] and not is_admin(user.id):
+        member = await context.bot.get_chat_member(chat_id, user.id)
+        if member.status not in ("administrator", "creator"):
+            await update.message.reply_html("Менять часовой пояс могут только админы чата. 🙅")
+            return
+
+    tz_name = context.args[0]
+    try:
+        store.set_chat_timezone(chat_id, tz_name)
+    except ValueError:
+        await update.message.reply_html(f"Не знаю такой часовой пояс: <code>{html.escape(tz_name)}</code> 🤔")
+        return
+    log_action("TIMEZONE_SET", f"User {user.id} ({user.first_name}) set timezone {tz_name} in chat {chat_id}")
+
+    if chat_id in TRACKED_CHATS:
+        for job in context.application.job_queue.get_jobs_by_name(f"daily_weather_{chat_id}"):
+            job.schedule_removal()
+        schedule_daily_weather(context.application, chat_id)
+
+    await update.message.reply_html(f"✅ Часовой пояс чата: <b>{tz_name}</b>. \"Сегодня\" теперь считается по нему.")
+
+# Leaderboard callback_data: "lb:<period>" for the first page, "lb:<period>:<n|p>:<count>:<user_id>"
+# for the page after / before that row. Telegram caps callback_data at 64 bytes.
+LEADERBOARD_PERIODS = {
+    "t": ("Сегодня", "today"),
+    "w": ("Неделя", "week"),
+    "m": ("Месяц", "month"),
+    "a": ("Всё время", "all"),
+}
+# Buttons sent before pagination existed.
+LEGACY_LEADERBOARD_CALLBACKS = {
+    "leaderboard_today": "t",
+    "leaderboard_week": "w",
+    "leaderboard_month": "m",
+    "leaderboard_all": "a",
+}
+
+def parse_leaderboard_callback(data):
+    """(period code, after, before) from leaderboard callback_data, or None if it is invalid."""
+    if data in LEGACY_LEADERBOARD_CALLBACKS:
+        return LEGACY_LEADERBOARD_CALLBACKS[data], None, None
+    parts = data.split(":")
+    if len(parts) < 2 or parts[0] != "lb" or parts[1] not in LEADERBOARD_PERIODS:
+        return None
+    if len(parts) == 2:
+        return parts[1], None, None
+    if len(parts) != 5 or parts[2] not in ("n", "p"):
+        return None
+    try:
+        cursor = (int(parts[3]), int(parts[4]))
+    except ValueError:
+        return None
+    return (parts[1], cursor, None) if parts[2] == "n" else (parts[1], None, cursor)
+
+def leaderboard_keyboard(code=None, rows=(), has_prev=False, has_next=False):
+    keyboard = []
+    nav = []
+    if has_prev:
+        _, _, count, user_id = rows[0]
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"lb:{code}:p:{count}:{user_id}"))
+    if has_next:
+        _, _, count, user_id = rows[-1]
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"lb:{code}:n:{count}:{user_id}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard += [
+        [InlineKeyboardButton("Сегодня", callback_data="lb:t"),
+         InlineKeyboardButton("Неделя", callback_data="lb:w")],
+        [InlineKeyboardButton("Месяц", callback_data="lb:m"),
+         InlineKeyboardButton("Всё время", callback_data="lb:a")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user = update.effective_user
     log_action("LEADERBOARD_COMMAND", f"User {user.id} ({user.first_name}) requested leaderboard in chat {chat_id}")
     await capture_user(update, context)
 
-    keyboard = [
-        [InlineKeyboardButton("Сегодня", callback_data="leaderboard_today"),
-         InlineKeyboardButton("Неделя", callback_data="leaderboard_week")],
-        [InlineKeyboardButton("Месяц", callback_data="leaderboard_month"),
-         InlineKeyboardButton("Всё время", callback_data="leaderboard_all")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_html(
         "🏆 <b>Топ курильщиков:</b>\n\n"
         "Выбери период:",
-        reply_markup=reply_markup
+        reply_markup=leaderboard_keyboard()
     )
 
 
@@ -449,39 +672,77 @@ async def leaderboard_button_handler(update: Update, context: ContextTypes.DEFAU
     user = query.from_user
     chat_id = query.message.chat_id
 
-    period_map = {
-        "leaderboard_today": ("Сегодня", "today"),
-        "leaderboard_week": ("Неделя", "week"),
-        "leaderboard_month": ("Месяц", "month"),
-        "leaderboard_all": ("Всё время", "all"),
-    }
-
-    period_key = query.data
-    if period_key not in period_map:
+    parsed = parse_leaderboard_callback(query.data)
+    if parsed is None:
         return
 
-    period_name, period = period_map[period_key]
+    code, after, before = parsed
+    period_name, period = LEADERBOARD_PERIODS[code]
     log_action("LEADERBOARD_BUTTON", f"User {user.id} ({user.first_name}) viewed {period_name} leaderboard in chat {chat_id}")
 
-    leaders = database.get_smoke_leaderboard_for_period(chat_id, period)
+    rows, has_prev, has_next = store.get_leaderboard_page(chat_id, period, after=after, before=before)
 
-    if not leaders:
+    if not rows:
         text = f"🏆 <b>Топ за {period_name}:</b>\n\nПока никто не отметился..."
     else:
         lines = [f"🏆 <b>Топ за {period_name}:</b>\n"]
-        for i, (name, count) in enumerate(leaders, start=1):
-            lines.append(f"{i}. {name}: <b>{count}</b>")
+        for rank, name, count, _ in rows:
+            lines.append(f"{rank}. {name}: <b>{count}</b>")
         text = "\n".join(lines)
 
-    keyboard = [
-        [InlineKeyboardButton("Сегодня", callback_data="leaderboard_today"),
-         InlineKeyboardButton("Неделя", callback_data="leaderboard_week")],
-        [InlineKeyboardButton("Месяц", callback_data="leaderboard_month"),
-         InlineKeyboardButton("Всё время", callback_data="leaderboard_all")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        text, parse_mode="HTML", reply_markup=leaderboard_keyboard(code, rows, has_prev, has_next)
+    )
+
+async def db_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        return
+    log_action("DB_PROFILE_COMMAND", f"User {user.id} ({user.first_name}) requested query profile")
+
+    if not database.PROFILE_ENABLED:
+        await update.message.reply_html("Профайлер выключен. Запусти бота с <code>DB_PROFILE=1</code>.")
+        return
+
+    database.dump_query_profile()
+    if context.args and context.args[0] == "reset":
+        database.reset_query_profile()
+        await update.message.reply_html("Статистика запросов сброшена. 🧹")
+        return
+
+    # Telegram caps messages at 4096 characters after entities are parsed. Cut the plain
+    # text, so the cut never lands inside an escaped entity.
+    report = html.escape(database.format_query_profile()[:3900])
+    await update.message.reply_html(f"<pre>{report}</pre>")
+
+async def smoke_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    if not is_admin(user.id):
+        return
+
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in export.FORMATS:
+        await update.message.reply_html(f"Формат: <code>/smoke_export [{'|'.join(export.FORMATS)}]</code>")
+        return
+    log_action("EXPORT_COMMAND", f"User {user.id} ({user.first_name}) exported {fmt} history of chat {chat_id}")
 
-    await query.edit_message_text(text, parse_mode="HTML", reply_markup=reply_markup)
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export.export_history, store, chat_id, path, fmt)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f,
+                filename=f"smoke_history_{chat_id}.{fmt}.gz",
+                caption=f"📦 Выгружено строк: {count}"
+            )
+    finally:
+        os.remove(path)
+
+async def close_storage(application):
+    # Commits writes still queued by the write-behind storage.
+    store.close()
 
 async def handle_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.effective_user:
@@ -508,27 +769,34 @@ async def handle_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await smoke(update, context)
 
 def main():
+    global store
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         print("Error: TELEGRAM_BOT_TOKEN environment variable not set.")
         print("Please set it in your environment or .env file.")
         return
 
-    database.init_db()
+    store = storage.create_storage()
+    store.init()
 
-    application = ApplicationBuilder().token(token).build()
+    application = ApplicationBuilder().token(token).post_shutdown(close_storage).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("smoke", smoke))
     application.add_handler(CommandHandler("smoke_stats", smoke_stats))
+    application.add_handler(CommandHandler("smoke_history", smoke_history))
     application.add_handler(CommandHandler("leaderboard", leaderboard))
     application.add_handler(CommandHandler("smoke_leave", smoke_leave))
     application.add_handler(CommandHandler("smoke_join", smoke_join))
     application.add_handler(CommandHandler("weather_info", weather_info))
     application.add_handler(CommandHandler("weather_subscribe", weather_subscribe))
+    application.add_handler(CommandHandler("smoke_timezone", smoke_timezone))
+    application.add_handler(CommandHandler("db_profile", db_profile))
+    application.add_handler(CommandHandler("smoke_export", smoke_export))
     # Register more specific callback handlers first.
-    application.add_handler(CallbackQueryHandler(leaderboard_button_handler, pattern=r"^leaderboard_"))
+    application.add_handler(CallbackQueryHandler(leaderboard_button_handler, pattern=r"^(leaderboard_|lb:)"))
     application.add_handler(CallbackQueryHandler(button_handler, pattern=r"^toggle_"))
+    application.add_handler(CallbackQueryHandler(refresh_weather_handler, pattern=r"^refresh_weather$"))
 
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_mention))
     application.add_handler(MessageHandler(filters.ALL, capture_user), group=1)
@@ -536,10 +804,15 @@ def main():
     for chat_id in TRACKED_CHATS:
         schedule_daily_weather(application, chat_id)
 
+    application.job_queue.run_repeating(
+        run_db_maintenance,
+        interval=datetime.timedelta(hours=MAINTENANCE_INTERVAL_HOURS),
+        first=datetime.timedelta(minutes=5),
+        name="db_maintenance"
+    )
+
     print("Bot is running...")
     application.run_polling()
 
 if __name__ == "__main__":
-    from dotenv import load_dotenv
-    load_dotenv()
     main()
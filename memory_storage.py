@@ -0,0 +1,262 @@
+import bisect
+import collections
+import datetime
+import threading
+import database
+from storage import Storage
+
+HISTORY_CHUNK = 1000
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+def _format_ts(ts):
+    return ts.strftime("%Y-%m-%d %H:%M:%S")
+
+class MemoryStorage(Storage):
+    """Non-persistent Storage kept entirely in process memory.
+
+    Events and RSVPs are kept per chat in lists sorted by (local_day, timestamp), so
+    every period query is a bisect plus a scan of the matching tail. A counter of RSVPs
+    per (chat, user, local_day) answers the "same-day RSVP" check of the leaderboard in
+    O(1).
+    """
+
+    def __init__(self, clock=_utcnow):
+        super().__init__()
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._participants = {}                           # user_id -> [mention_name, is_active]
+        self._timezones = {}                              # chat_id -> IANA timezone name
+        self._events = collections.defaultdict(list)      # chat_id -> [(local_day, ts, event_id, user_id)]
+        self._event_seq = 0
+        self._rsvps = collections.defaultdict(dict)       # chat_id -> {(user_id, message_id): (local_day, ts)}
+        self._rsvp_index = collections.defaultdict(list)  # chat_id -> [(local_day, ts, user_id, message_id)]
+        self._rsvp_days = collections.Counter()           # (chat_id, user_id, local_day) -> RSVPs
+        self._totals = collections.defaultdict(dict)      # chat_id -> {user_id: [event_count, call_count]}
+        self._heatmap = collections.defaultdict(lambda: [[0] * 24 for _ in range(7)])  # chat_id -> [weekday][hour]
+        self._streaks = {}                                # (chat_id, user_id) -> [current, best, last_day]
+
+    def _now(self):
+        return self._clock().replace(microsecond=0)
+
+    def _local_today(self, chat_id):
+        now = self._now().replace(tzinfo=datetime.timezone.utc)
+        return now.astimezone(database.get_zone(self.get_chat_timezone(chat_id))).date()
+
+    def _period_start_day(self, chat_id, period):
+        if period == 'all':
+            return None
+        days = database.PERIOD_DAYS.get(period, database.PERIOD_DAYS['week'])
+        return (self._local_today(chat_id) - datetime.timedelta(days=days - 1)).isoformat()
+
+    def _window(self, entries, chat_id, period):
+        start_day = self._period_start_day(chat_id, period)
+        if start_day is None:
+            return entries
+        return entries[bisect.bisect_left(entries, (start_day,)):]
+
+    def _ranking(self, counts):
+        rows = [
+            (user_id, self._participants[user_id][0], count)
+            for user_id, count in counts.items()
+            if user_id in self._participants
+        ]
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def _ranked(self, counts, limit=None):
+        return [(name, count) for _, name, count in self._ranking(counts)[:limit]]
+
+    def add_or_update_user(self, user_id, mention_name):
+        with self._lock:
+            if user_id in self._participants:
+                self._participants[user_id][0] = mention_name
+            else:
+                self._participants[user_id] = [mention_name, True]
+
+    def set_user_active(self, user_id, is_active):
+        with self._lock:
+            if user_id in self._participants:
+                self._participants[user_id][1] = bool(is_active)
+
+    def is_user_active(self, user_id):
+        with self._lock:
+            user = self._participants.get(user_id)
+            return user[1] if user else False
+
+    def get_active_users(self):
+        with self._lock:
+            return [(user_id, name) for user_id, (name, active) in sorted(self._participants.items()) if active]
+
+    def get_chat_timezone(self, chat_id):
+        with self._lock:
+            return self._timezones.get(chat_id, database.DEFAULT_TIMEZONE)
+
+    def set_chat_timezone(self, chat_id, tz_name):
+        if not database.is_valid_timezone(tz_name):
+            raise ValueError(f"Unknown timezone: {tz_name}")
+        with self._lock:
+            self._timezones[chat_id] = tz_name
+        self._rankings.invalidate(chat_id)
+
+    def _now_and_local(self, chat_id):
+        now = self._now()
+        return now, now.replace(tzinfo=datetime.timezone.utc).astimezone(database.get_zone(self.get_chat_timezone(chat_id)))
+
+    def _record_streak(self, chat_id, user_id, local_day):
+        day = datetime.date.fromisoformat(local_day)
+        streak = self._streaks.get((chat_id, user_id))
+        if streak is None:
+            self._streaks[(chat_id, user_id)] = [1, 1, day]
+            return
+        if day <= streak[2]:
+            return
+        streak[0] = streak[0] + 1 if day - streak[2] == datetime.timedelta(days=1) else 1
+        streak[1] = max(streak[1], streak[0])
+        streak[2] = day
+
+    def log_smoke_event(self, chat_id, user_id):
+        with self._lock:
+            ts, local = self._now_and_local(chat_id)
+            local_day = local.date().isoformat()
+            self._event_seq += 1
+            bisect.insort(self._events[chat_id], (local_day, ts, self._event_seq, user_id))
+            self._heatmap[chat_id][local.weekday()][local.hour] += 1
+            self._record_streak(chat_id, user_id, local_day)
+            self._rankings.invalidate(chat_id)
+
+    def toggle_smoke_participation(self, user_id, chat_id, message_id):
+        with self._lock:
+            rsvps = self._rsvps[chat_id]
+            key = (user_id, message_id)
+            existing = rsvps.pop(key, None)
+            if existing is not None:
+                local_day, ts = existing
+                index = self._rsvp_index[chat_id]
+                del index[bisect.bisect_left(index, (local_day, ts, user_id, message_id))]
+                self._rsvp_days[(chat_id, user_id, local_day)] -= 1
+                self._rankings.invalidate(chat_id)
+                return False
+            ts, local = self._now_and_local(chat_id)
+            local_day = local.date().isoformat()
+            rsvps[key] = (local_day, ts)
+            bisect.insort(self._rsvp_index[chat_id], (local_day, ts, user_id, message_id))
+            self._rsvp_days[(chat_id, user_id, local_day)] += 1
+            self._record_streak(chat_id, user_id, local_day)
+            self._rankings.invalidate(chat_id)
+            return True
+
+    def is_participating(self, user_id, chat_id, message_id):
+        with self._lock:
+            return (user_id, message_id) in self._rsvps[chat_id]
+
+    def get_smoke_stats(self, chat_id):
+        with self._lock:
+            events = self._events[chat_id]
+            return (
+                len(self._window(events, chat_id, 'today')),
+                len(self._window(events, chat_id, 'week')),
+            )
+
+    def _rsvp_counts(self, chat_id, period):
+        index = self._window(self._rsvp_index[chat_id], chat_id, period)
+        return collections.Counter(user_id for _, _, user_id, _ in index)
+
+    def get_smoke_leaderboard(self, chat_id):
+        with self._lock:
+            return (
+                self._ranked(self._rsvp_counts(chat_id, 'today'), 5),
+                self._ranked(self._rsvp_counts(chat_id, 'week'), 5),
+            )
+
+    def get_smoke_history(self, chat_id, limit=5):
+        with self._lock:
+            heatmap = [list(row) for row in self._heatmap[chat_id]]
+            yesterday = self._local_today(chat_id) - datetime.timedelta(days=1)
+            rows = [
+                (self._participants[user_id][0], current if last_day >= yesterday else 0, best, user_id)
+                for (streak_chat_id, user_id), (current, best, last_day) in self._streaks.items()
+                if streak_chat_id == chat_id and user_id in self._participants
+            ]
+        rows.sort(key=lambda row: (-row[2], -row[1], row[3]))
+        return heatmap, [(name, current, best) for name, current, best, _ in rows[:limit]]
+
+    def get_monthly_stats(self, chat_id):
+        with self._lock:
+            events = self._window(self._events[chat_id], chat_id, 'month')
+            top = self._ranked(collections.Counter(user_id for _, _, _, user_id in events), 1)
+            return len(events), (top[0] if top else None), self._ranked(self._rsvp_counts(chat_id, 'month'), 5)
+
+    def _period_counts(self, chat_id, period):
+        if period not in ('today', 'week', 'month', 'all'):
+            period = 'week'
+        counts = self._rsvp_counts(chat_id, period)
+        for local_day, _, _, user_id in self._window(self._events[chat_id], chat_id, period):
+            if not self._rsvp_days[(chat_id, user_id, local_day)]:
+                counts[user_id] += 1
+        if period == 'all':
+            for user_id, (event_count, _) in self._totals[chat_id].items():
+                counts[user_id] += event_count
+        return counts
+
+    def get_smoke_leaderboard_for_period(self, chat_id, period='week', limit=10):
+        with self._lock:
+            return self._ranked(self._period_counts(chat_id, period), limit)
+
+    def get_leaderboard_ranking(self, chat_id, period='week'):
+        with self._lock:
+            return self._ranking(self._period_counts(chat_id, period))
+
+    def iter_chat_history(self, chat_id, chunk_size=HISTORY_CHUNK):
+        with self._lock:
+            events = sorted(self._events[chat_id], key=lambda event: (event[0], event[2]))
+            rsvps = list(self._rsvp_index[chat_id])
+        rows = [
+            ('call', chat_id, user_id, None, event_id, _format_ts(ts), local_day)
+            for local_day, ts, event_id, user_id in events
+        ]
+        rows += [
+            ('rsvp', chat_id, user_id, message_id, None, _format_ts(ts), local_day)
+            for local_day, ts, user_id, message_id in rsvps
+        ]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def run_maintenance(self, retention_days=None):
+        """Fold events older than the retention horizon, like database.run_maintenance()."""
+        if retention_days is None:
+            retention_days = database.RETENTION_DAYS
+        retention_days = max(retention_days, database.MIN_RETENTION_DAYS)
+        cutoff = (self._now().date() - datetime.timedelta(days=retention_days)).isoformat()
+        stats = {"days_folded": 0, "events_deleted": 0, "participation_deleted": 0, "pages_freed": 0}
+        folded_days = set()
+
+        with self._lock:
+            for chat_id in set(self._events) | set(self._rsvp_index):
+                totals = self._totals[chat_id]
+                events = self._events[chat_id]
+                old_events = events[:bisect.bisect_left(events, (cutoff,))]
+                for local_day, _, _, user_id in old_events:
+                    total = totals.setdefault(user_id, [0, 0])
+                    total[0] += not self._rsvp_days[(chat_id, user_id, local_day)]
+                    total[1] += 1
+                    folded_days.add(local_day)
+                del events[:len(old_events)]
+
+                index = self._rsvp_index[chat_id]
+                old_rsvps = index[:bisect.bisect_left(index, (cutoff,))]
+                for local_day, _, user_id, message_id in old_rsvps:
+                    totals.setdefault(user_id, [0, 0])[0] += 1
+                    del self._rsvps[chat_id][(user_id, message_id)]
+                    self._rsvp_days[(chat_id, user_id, local_day)] -= 1
+                    folded_days.add(local_day)
+                del index[:len(old_rsvps)]
+
+                stats["events_deleted"] += len(old_events)
+                stats["participation_deleted"] += len(old_rsvps)
+            self._rsvp_days = +self._rsvp_days
+        self._rankings.invalidate()
+
+        stats["days_folded"] = len(folded_days)
+        return stats
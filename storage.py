@@ -0,0 +1,265 @@
+import abc
+import bisect
+import os
+import threading
+import time
+import database
+
+# Which Storage implementation create_storage() builds: "sqlite" or "memory".
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+# Group-commit smoke events and RSVP toggles through writebehind.WriteBehindStorage.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+# Ranked leaderboard snapshots are rebuilt at most this often unless the chat is written to.
+RANKING_CACHE_SECONDS = float(os.getenv("RANKING_CACHE_SECONDS", "60"))
+LEADERBOARD_PAGE_SIZE = 10
+
+class RankingCache:
+    """Ranked leaderboard snapshots per (chat_id, period).
+
+    A snapshot is dropped after RANKING_CACHE_SECONDS or as soon as its chat is
+    invalidated. Snapshots built while a write was in flight carry the old version and
+    are never served.
+    """
+
+    def __init__(self, ttl=None):
+        self._ttl = RANKING_CACHE_SECONDS if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped by invalidate() without a chat
+        self._versions = {}   # chat_id -> invalidations of that chat
+        self._snapshots = {}  # (chat_id, period) -> (version, built_at, keys, ranking)
+
+    def _version(self, chat_id):
+        return self._generation, self._versions.get(chat_id, 0)
+
+    def get(self, chat_id, period, build):
+        """(keys, ranking) for the chat and period, calling build() on a miss.
+
+        keys[i] is (-count, user_id) of ranking[i], so a (count, user_id) cursor can be
+        bisected into the snapshot.
+        """
+        with self._lock:
+            version = self._version(chat_id)
+            cached = self._snapshots.get((chat_id, period))
+        if cached is not None and cached[0] == version and time.monotonic() - cached[1] < self._ttl:
+            return cached[2], cached[3]
+
+        built_at = time.monotonic()
+        ranking = build()
+        keys = [(-count, user_id) for user_id, _, count in ranking]
+        with self._lock:
+            self._snapshots[(chat_id, period)] = (version, built_at, keys, ranking)
+        return keys, ranking
+
+    def invalidate(self, chat_id=None):
+        """Drop the snapshots of one chat, or of every chat."""
+        with self._lock:
+            if chat_id is None:
+                self._generation += 1
+                self._snapshots.clear()
+            else:
+                self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+                for period in database.PERIOD_DAYS.keys() | {'all'}:
+                    self._snapshots.pop((chat_id, period), None)
+
+class Storage(abc.ABC):
+    """Persistence used by the bot handlers.
+
+    Return values mirror the original `database` functions: rows are tuples, users are
+    (user_id, mention_name) and leaderboards are (mention_name, count) ordered by count
+    descending, then user_id.
+    """
+
+    def __init__(self):
+        self._rankings = RankingCache()
+
+    def init(self):
+        pass
+
+    @abc.abstractmethod
+    def add_or_update_user(self, user_id, mention_name):
+        ...
+
+    @abc.abstractmethod
+    def set_user_active(self, user_id, is_active):
+        ...
+
+    @abc.abstractmethod
+    def is_user_active(self, user_id):
+        ...
+
+    @abc.abstractmethod
+    def get_active_users(self):
+        ...
+
+    @abc.abstractmethod
+    def get_chat_timezone(self, chat_id):
+        """IANA timezone used for the chat's local days."""
+
+    @abc.abstractmethod
+    def set_chat_timezone(self, chat_id, tz_name):
+        """Raises ValueError for unknown zones."""
+
+    @abc.abstractmethod
+    def log_smoke_event(self, chat_id, user_id):
+        ...
+
+    @abc.abstractmethod
+    def toggle_smoke_participation(self, user_id, chat_id, message_id):
+        """Join or leave a smoke message, returns True if the user is now joined."""
+
+    @abc.abstractmethod
+    def is_participating(self, user_id, chat_id, message_id):
+        ...
+
+    def apply_writes(self, ops):
+        """Apply a batch of queued writes, see database.apply_write_batch() for the format.
+
+        Backends without a cheaper batch path replay them one by one.
+        """
+        for op in ops:
+            if op[0] == 'event':
+                self.log_smoke_event(op[1], op[2])
+            else:
+                _, user_id, chat_id, message_id, joined, _ = op
+                if self.is_participating(user_id, chat_id, message_id) != joined:
+                    self.toggle_smoke_participation(user_id, chat_id, message_id)
+
+    @abc.abstractmethod
+    def get_smoke_stats(self, chat_id):
+        """(today_count, week_count) of /smoke calls."""
+
+    @abc.abstractmethod
+    def get_smoke_leaderboard(self, chat_id):
+        """(today_leaders, week_leaders) by RSVP joins, top 5 each."""
+
+    @abc.abstractmethod
+    def get_monthly_stats(self, chat_id):
+        """(month_count, top_smoker or None, month_leaders)."""
+
+    @abc.abstractmethod
+    def get_smoke_leaderboard_for_period(self, chat_id, period='week', limit=10):
+        ...
+
+    @abc.abstractmethod
+    def get_leaderboard_ranking(self, chat_id, period='week'):
+        """The full get_smoke_leaderboard_for_period() ranking as (user_id, mention_name, count)."""
+
+    def get_leaderboard_page(self, chat_id, period='week', after=None, before=None, page_size=LEADERBOARD_PAGE_SIZE):
+        """One leaderboard page as ([(rank, mention_name, count, user_id)], has_prev, has_next).
+
+        `after` and `before` are keyset cursors: the (count, user_id) of the last row of
+        the previous page or the first row of the next one. Pages are cut from a ranked
+        snapshot cached per chat and period, so any page costs two bisects once the
+        snapshot is built.
+        """
+        if period not in database.PERIOD_DAYS and period != 'all':
+            period = 'week'
+        keys, ranking = self._rankings.get(chat_id, period, lambda: self.get_leaderboard_ranking(chat_id, period))
+        if before is not None:
+            end = bisect.bisect_left(keys, (-before[0], before[1]))
+            start = max(end - page_size, 0)
+        else:
+            start = bisect.bisect_right(keys, (-after[0], after[1])) if after is not None else 0
+            # The rows past the cursor may be gone by now; show the last page instead.
+            if start >= len(ranking):
+                start = max(len(ranking) - page_size, 0)
+        end = min(start + page_size, len(ranking))
+        rows = [(rank, name, count, user_id) for rank, (user_id, name, count) in enumerate(ranking[start:end], start=start + 1)]
+        return rows, start > 0, end < len(ranking)
+
+    @abc.abstractmethod
+    def get_smoke_history(self, chat_id, limit=5):
+        """(heatmap[weekday][hour], [(mention_name, current_streak, best_streak)])."""
+
+    @abc.abstractmethod
+    def iter_chat_history(self, chat_id, chunk_size=1000):
+        """Yield chunks of rows shaped like database.HISTORY_COLUMNS."""
+
+    def run_maintenance(self):
+        return {}
+
+    def close(self):
+        pass
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_path=None):
+        super().__init__()
+        self.db_path = db_path if db_path is not None else database.DB_PATH
+
+    def init(self):
+        database.init_db(self.db_path)
+
+    def add_or_update_user(self, user_id, mention_name):
+        database.add_or_update_user(user_id, mention_name, db_path=self.db_path)
+
+    def set_user_active(self, user_id, is_active):
+        database.set_user_active(user_id, is_active, db_path=self.db_path)
+
+    def is_user_active(self, user_id):
+        return database.is_user_active(user_id, db_path=self.db_path)
+
+    def get_active_users(self):
+        return database.get_active_users(db_path=self.db_path)
+
+    def get_chat_timezone(self, chat_id):
+        return database.get_chat_timezone(chat_id, db_path=self.db_path)
+
+    def set_chat_timezone(self, chat_id, tz_name):
+        database.set_chat_timezone(chat_id, tz_name, db_path=self.db_path)
+        self._rankings.invalidate(chat_id)
+
+    def log_smoke_event(self, chat_id, user_id):
+        database.log_smoke_event(chat_id, user_id, db_path=self.db_path)
+        self._rankings.invalidate(chat_id)
+
+    def toggle_smoke_participation(self, user_id, chat_id, message_id):
+        joined = database.toggle_smoke_participation(user_id, chat_id, message_id, db_path=self.db_path)
+        self._rankings.invalidate(chat_id)
+        return joined
+
+    def is_participating(self, user_id, chat_id, message_id):
+        return database.is_participating(user_id, chat_id, message_id, db_path=self.db_path)
+
+    def apply_writes(self, ops):
+        database.apply_write_batch(ops, db_path=self.db_path)
+        for chat_id in {op[1] if op[0] == 'event' else op[2] for op in ops}:
+            self._rankings.invalidate(chat_id)
+
+    def get_smoke_stats(self, chat_id):
+        return database.get_smoke_stats(chat_id, db_path=self.db_path)
+
+    def get_smoke_leaderboard(self, chat_id):
+        return database.get_smoke_leaderboard(chat_id, db_path=self.db_path)
+
+    def get_monthly_stats(self, chat_id):
+        return database.get_monthly_stats(chat_id, db_path=self.db_path)
+
+    def get_smoke_leaderboard_for_period(self, chat_id, period='week', limit=10):
+        return database.get_smoke_leaderboard_for_period(chat_id, period, limit, db_path=self.db_path)
+
+    def get_leaderboard_ranking(self, chat_id, period='week'):
+        return database.get_leaderboard_ranking(chat_id, period, db_path=self.db_path)
+
+    def get_smoke_history(self, chat_id, limit=5):
+        return database.get_smoke_history(chat_id, limit, db_path=self.db_path)
+
+    def iter_chat_history(self, chat_id, chunk_size=1000):
+        return database.iter_chat_history(chat_id, chunk_size, db_path=self.db_path)
+
+    def run_maintenance(self):
+        stats = database.run_maintenance(db_path=self.db_path)
+        self._rankings.invalidate()
+        return stats
+
+def create_storage(backend=None):
+    if backend is None:
+        backend = STORAGE_BACKEND
+    if backend == "sqlite":
+        if WRITE_BEHIND:
+            from writebehind import WriteBehindStorage
+            return WriteBehindStorage(SQLiteStorage())
+        return SQLiteStorage()
+    if backend == "memory":
+        from memory_storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,51 @@
+import datetime
+import types
+import pytest
+import database
+from memory_storage import MemoryStorage
+from storage import SQLiteStorage
+
+# A Wednesday, 14:30 in the default Asia/Almaty timezone.
+NOW = datetime.datetime(2025, 6, 11, 9, 30)
+
+class Clock:
+    """Naive UTC time that tests move by hand."""
+
+    def __init__(self, now=NOW):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def set(self, days_ago=0, **delta):
+        self.now = NOW - datetime.timedelta(days=days_ago, **delta)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen time for both backends: MemoryStorage takes it as its clock, database.py
+    gets it through a patched datetime.datetime.now()."""
+    clock = Clock()
+
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            now = clock.now.replace(tzinfo=datetime.timezone.utc)
+            return now.astimezone(tz) if tz is not None else now.replace(tzinfo=None)
+
+    monkeypatch.setattr(database, "datetime", types.SimpleNamespace(
+        datetime=FrozenDatetime,
+        date=datetime.date,
+        timedelta=datetime.timedelta,
+        timezone=datetime.timezone,
+    ))
+    return clock
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, tmp_path, clock):
+    if request.param == "sqlite":
+        store = SQLiteStorage(str(tmp_path / "smoke.db"))
+    else:
+        store = MemoryStorage(clock=clock)
+    store.init()
+    yield store
+    store.close()
@@ -0,0 +1,12 @@
+import sqlite3
+import database
+
+def test_history_queries_stream_without_a_sort(tmp_path):
+    path = str(tmp_path / "smoke.db")
+    database.init_db(path)
+    conn = sqlite3.connect(path)
+    for query in database.HISTORY_QUERIES:
+        plan = [detail for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {query}", (-1,))]
+        assert any("USING INDEX" in detail for detail in plan), plan
+        assert not any("TEMP B-TREE" in detail for detail in plan), plan
+    conn.close()
@@ -0,0 +1,174 @@
+import sqlite3
+import statistics
+import time
+import benchmark
+import database
+
+def tables(path):
+    conn = sqlite3.connect(path)
+    names = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    return names
+
+def schema_version(path):
+    conn = sqlite3.connect(path)
+    version = database.get_schema_version(conn)
+    conn.close()
+    return version
+
+def test_fresh_database(tmp_path):
+    path = str(tmp_path / "fresh.db")
+    database.init_db(path)
+    assert schema_version(path) == database.SCHEMA_VERSION
+    assert {"participants", "smoke_events", "smoke_participation", "smoke_totals",
+            "chat_settings", "smoke_heatmap", "smoke_streaks"} <= tables(path)
+
+def make_v1_db(path, events, rsvps=()):
+    """A database left at schema version 1, with (chat_id, user_id, timestamp) events and
+    (user_id, chat_id, message_id, timestamp) RSVPs."""
+    conn = sqlite3.connect(path)
+    database._migrate_base_tables(conn.cursor())
+    conn.execute("INSERT INTO db_version (key, value) VALUES ('schema_version', '1')")
+    conn.execute("INSERT INTO participants (user_id, mention_name) VALUES (1, 'u1'), (2, 'u2')")
+    conn.executemany("INSERT INTO smoke_events (chat_id, user_id, timestamp) VALUES (?, ?, ?)", events)
+    conn.executemany("INSERT INTO smoke_participation (user_id, chat_id, message_id, timestamp) VALUES (?, ?, ?, ?)", rsvps)
+    conn.commit()
+    conn.close()
+
+def test_upgrade_from_version_1(tmp_path):
+    path = str(tmp_path / "v1.db")
+    make_v1_db(
+        path,
+        [(-1, 1, "2025-06-09 09:00:00"), (-1, 1, "2025-06-10 09:00:00"), (-1, 2, "2025-06-10 10:00:00")],
+        [(2, -1, 7, "2025-06-10 10:00:00")],
+    )
+
+    database.init_db(path)
+    assert schema_version(path) == database.SCHEMA_VERSION
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT user_id, local_day FROM smoke_events ORDER BY id").fetchall() == [
+        (1, "2025-06-09"), (1, "2025-06-10"), (2, "2025-06-10"),
+    ]
+    assert conn.execute("SELECT user_id, message_id, local_day FROM smoke_participation").fetchall() == [
+        (2, 7, "2025-06-10"),
+    ]
+    assert conn.execute("SELECT sum(count) FROM smoke_heatmap WHERE chat_id = -1").fetchone() == (3,)
+    assert conn.execute(
+        "SELECT user_id, current_streak, best_streak, last_day FROM smoke_streaks ORDER BY user_id"
+    ).fetchall() == [(1, 2, 2, "2025-06-10"), (2, 1, 1, "2025-06-10")]
+    conn.close()
+    assert database.get_smoke_leaderboard_for_period(-1, 'all', db_path=path) == [("u1", 2), ("u2", 1)]
+
+def test_backfill_uses_historical_offsets(tmp_path):
+    # Asia/Almaty was UTC+6 until 2024-03-01 and is UTC+5 since.
+    path = str(tmp_path / "v1.db")
+    make_v1_db(
+        path,
+        [(-1, 1, "2023-06-01 18:30:00"), (-1, 1, "2024-06-01 18:30:00")],
+        [(2, -1, 7, "2023-06-01 18:30:00")],
+    )
+
+    conn = sqlite3.connect(path)
+    # Chats with their own zone, as /smoke_timezone would have stored it before v6.
+    conn.execute("CREATE TABLE chat_settings (chat_id INTEGER PRIMARY KEY, timezone TEXT NOT NULL)")
+    conn.execute("INSERT INTO chat_settings (chat_id, timezone) VALUES (-2, 'Europe/Berlin')")
+    conn.executemany(
+        "INSERT INTO smoke_events (chat_id, user_id, timestamp) VALUES (-2, 1, ?)",
+        [("2024-01-10 12:00:00",), ("2024-07-10 12:00:00",)]
+    )
+    conn.commit()
+    conn.close()
+
+    database.init_db(path)
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT local_day FROM smoke_events WHERE chat_id = -1 ORDER BY id").fetchall() == [
+        ("2023-06-02",), ("2024-06-01",),
+    ]
+    assert conn.execute("SELECT local_day FROM smoke_participation").fetchall() == [("2023-06-02",)]
+    # (chat_id, weekday, hour): Friday 00:30 and Saturday 23:30 in Almaty, a Wednesday
+    # at 13:00 (CET) and 14:00 (CEST) in Berlin.
+    assert conn.execute("SELECT chat_id, weekday, hour, count FROM smoke_heatmap ORDER BY 1, 2, 3").fetchall() == [
+        (-2, 2, 13, 1), (-2, 2, 14, 1), (-1, 4, 0, 1), (-1, 5, 23, 1),
+    ]
+    conn.close()
+
+def test_upgrade_skips_rows_without_timestamp(tmp_path):
+    path = str(tmp_path / "v1.db")
+    make_v1_db(
+        path,
+        [(-1, 1, None), (-1, 1, "2025-06-10 09:00:00")],
+        [(1, -1, 7, None)],
+    )
+
+    database.init_db(path)
+    assert schema_version(path) == database.SCHEMA_VERSION
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT local_day FROM smoke_events ORDER BY id").fetchall() == [(None,), ("2025-06-10",)]
+    assert conn.execute("SELECT sum(count) FROM smoke_heatmap").fetchone() == (1,)
+    assert conn.execute("SELECT user_id, current_streak, best_streak, last_day FROM smoke_streaks").fetchall() == [
+        (1, 1, 1, "2025-06-10"),
+    ]
+    conn.close()
+
+def test_upgrade_from_chat_keyed_participants(tmp_path):
+    path = str(tmp_path / "old_pk.db")
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE participants (
+            user_id INTEGER,
+            chat_id INTEGER,
+            mention_name TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO participants (user_id, chat_id, mention_name, is_active) VALUES (?, ?, ?, ?)",
+        [(1, -1, "u1", 1), (1, -2, "u1", 1), (2, -1, "u2", 0)]
+    )
+    conn.execute("CREATE TABLE smoke_events (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, user_id INTEGER, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+    conn.execute("INSERT INTO smoke_events (chat_id, user_id, timestamp) VALUES (-1, 1, '2025-06-10 09:00:00')")
+    conn.commit()
+    conn.close()
+
+    database.init_db(path)
+    assert schema_version(path) == database.SCHEMA_VERSION
+
+    conn = sqlite3.connect(path)
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'participants'").fetchone()[0]
+    assert "chat_id" not in table_sql
+    assert conn.execute("SELECT user_id, mention_name, is_active FROM participants ORDER BY user_id").fetchall() == [
+        (1, "u1", 1), (2, "u2", 0),
+    ]
+    assert conn.execute("SELECT chat_id, user_id, local_day FROM smoke_events").fetchall() == [(-1, 1, "2025-06-10")]
+    conn.close()
+
+def test_up_to_date_startup_is_one_statement(tmp_path, monkeypatch):
+    path = str(tmp_path / "smoke.db")
+    database.init_db(path)
+
+    monkeypatch.setattr(database, "PROFILE_ENABLED", True)
+    database.reset_query_profile()
+    try:
+        database.init_db(path)
+        profile = database.get_query_profile()
+    finally:
+        database.reset_query_profile()
+    assert [(sql, stats["calls"]) for sql, stats in profile] == [
+        ("SELECT value FROM db_version WHERE key = 'schema_version'", 1),
+    ]
+
+def test_startup_time_on_large_database(tmp_path):
+    path = str(tmp_path / "large.db")
+    benchmark.build_large_db(path, 100_000)
+
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        database.init_db(path)
+        timings.append(time.perf_counter() - start)
+    # A version read only; anything that scans the tables takes far longer than this.
+    assert statistics.median(timings) < 0.05
@@ -0,0 +1,178 @@
+"""Behaviour every Storage backend must share; each test runs once per backend."""
+import datetime
+import database
+
+CHAT = -100
+
+def add_users(store, *user_ids):
+    for user_id in user_ids:
+        store.add_or_update_user(user_id, f"u{user_id}")
+
+def seed_history(store, clock):
+    """Calls and RSVPs spread over two months, written in chronological order."""
+    add_users(store, 1, 2, 3, 4, 5)
+    clock.set(days_ago=60)
+    store.log_smoke_event(CHAT, 5)
+    clock.set(days_ago=10)
+    store.log_smoke_event(CHAT, 4)
+    clock.set(days_ago=1)
+    store.toggle_smoke_participation(2, CHAT, 50)
+    clock.set()
+    # The caller is auto-joined to their own smoke message, which must count once.
+    store.log_smoke_event(CHAT, 1)
+    store.toggle_smoke_participation(1, CHAT, 100)
+    store.log_smoke_event(CHAT, 2)
+    store.toggle_smoke_participation(3, CHAT, 101)
+    store.toggle_smoke_participation(3, CHAT, 102)
+    # Another chat never leaks into CHAT's numbers.
+    store.log_smoke_event(CHAT + 1, 5)
+    store.toggle_smoke_participation(5, CHAT + 1, 100)
+
+def test_users(store):
+    add_users(store, 1, 2)
+    store.add_or_update_user(1, "renamed")
+    assert store.get_active_users() == [(1, "renamed"), (2, "u2")]
+
+    store.set_user_active(2, False)
+    assert store.get_active_users() == [(1, "renamed")]
+    assert not store.is_user_active(2)
+    assert not store.is_user_active(99)
+
+    store.set_user_active(2, True)
+    assert store.is_user_active(2)
+    assert store.get_active_users() == [(1, "renamed"), (2, "u2")]
+
+def test_toggle_returns_new_state(store):
+    add_users(store, 1)
+    assert not store.is_participating(1, CHAT, 7)
+    assert store.toggle_smoke_participation(1, CHAT, 7) is True
+    assert store.is_participating(1, CHAT, 7)
+    assert not store.is_participating(1, CHAT, 8)
+    assert store.toggle_smoke_participation(1, CHAT, 7) is False
+    assert not store.is_participating(1, CHAT, 7)
+
+def test_stats(store, clock):
+    seed_history(store, clock)
+    assert store.get_smoke_stats(CHAT) == (2, 2)
+    assert store.get_smoke_leaderboard(CHAT) == (
+        [("u3", 2), ("u1", 1)],
+        [("u3", 2), ("u1", 1), ("u2", 1)],
+    )
+    assert store.get_monthly_stats(CHAT) == (3, ("u1", 1), [("u3", 2), ("u1", 1), ("u2", 1)])
+
+def test_empty_chat(store):
+    assert store.get_smoke_stats(CHAT) == (0, 0)
+    assert store.get_smoke_leaderboard(CHAT) == ([], [])
+    assert store.get_monthly_stats(CHAT) == (0, None, [])
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'all') == []
+    assert store.get_leaderboard_page(CHAT, 'all') == ([], False, False)
+
+def test_leaderboard_for_period(store, clock):
+    seed_history(store, clock)
+    # u1's call and RSVP on the same day count once; ties go to the lower user_id.
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'today') == [("u3", 2), ("u1", 1), ("u2", 1)]
+    week = [("u2", 2), ("u3", 2), ("u1", 1)]
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'week') == week
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'month') == week + [("u4", 1)]
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'all') == week + [("u4", 1), ("u5", 1)]
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'all', limit=2) == week[:2]
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'bogus') == week
+    assert store.get_leaderboard_ranking(CHAT, 'week') == [(2, "u2", 2), (3, "u3", 2), (1, "u1", 1)]
+
+def test_leaderboard_pages(store):
+    user_ids = list(range(1, 26))
+    add_users(store, *user_ids)
+    for user_id in user_ids:
+        for _ in range(user_id % 4 + 1):
+            store.log_smoke_event(CHAT, user_id)
+    expected = sorted(((user_id, f"u{user_id}", user_id % 4 + 1) for user_id in user_ids), key=lambda row: (-row[2], row[0]))
+    assert store.get_leaderboard_ranking(CHAT, 'today') == expected
+
+    pages = []
+    after = None
+    while True:
+        rows, has_prev, has_next = store.get_leaderboard_page(CHAT, 'today', after=after, page_size=10)
+        assert has_prev == bool(pages)
+        pages.append(rows)
+        if not has_next:
+            break
+        after = (rows[-1][2], rows[-1][3])
+    assert [len(rows) for rows in pages] == [10, 10, 5]
+    flat = [row for rows in pages for row in rows]
+    assert [rank for rank, _, _, _ in flat] == list(range(1, 26))
+    assert [(user_id, name, count) for _, name, count, user_id in flat] == expected
+
+    first = pages[-1][0]
+    assert store.get_leaderboard_page(CHAT, 'today', before=(first[2], first[3]), page_size=10) == (pages[1], True, True)
+    first = pages[1][0]
+    assert store.get_leaderboard_page(CHAT, 'today', before=(first[2], first[3]), page_size=10) == (pages[0], False, True)
+    # A cursor past the end, e.g. after the last rows left, falls back to the last ten rows.
+    assert store.get_leaderboard_page(CHAT, 'today', after=(0, 10**9), page_size=10) == (flat[-10:], True, False)
+
+    # Writes show up on the next page request.
+    for _ in range(3):
+        store.log_smoke_event(CHAT, 25)
+    rows, has_prev, has_next = store.get_leaderboard_page(CHAT, 'today', page_size=10)
+    assert rows[0] == (1, "u25", 5, 25)
+    assert (has_prev, has_next) == (False, True)
+
+def test_history(store, clock):
+    add_users(store, 1, 2)
+    calls = []
+    for days_ago, hours, user_id in ((5, 0, 2), (4, 0, 2), (3, 2, 1), (2, 1, 1), (1, 0, 1), (1, 0, 2)):
+        clock.set(days_ago=days_ago, hours=hours)
+        store.log_smoke_event(CHAT, user_id)
+        calls.append(clock.now)
+    clock.set()
+
+    expected = [[0] * 24 for _ in range(7)]
+    zone = database.get_zone(database.DEFAULT_TIMEZONE)
+    for when in calls:
+        local = when.replace(tzinfo=datetime.timezone.utc).astimezone(zone)
+        expected[local.weekday()][local.hour] += 1
+
+    heatmap, streaks = store.get_smoke_history(CHAT)
+    assert heatmap == expected
+    # u2's 4-5 days ago streak is broken by the gap before yesterday.
+    assert streaks == [("u1", 3, 3), ("u2", 1, 2)]
+    assert store.get_smoke_history(CHAT, limit=1)[1] == [("u1", 3, 3)]
+
+def test_iter_chat_history(store, clock):
+    seed_history(store, clock)
+    chunks = list(store.iter_chat_history(CHAT, chunk_size=2))
+    assert all(0 < len(chunk) <= 2 for chunk in chunks)
+    rows = [tuple(row) for chunk in chunks for row in chunk]
+
+    def stamp(days_ago):
+        return (clock.now - datetime.timedelta(days=days_ago)).strftime("%Y-%m-%d %H:%M:%S")
+
+    def day(days_ago):
+        # 14:30 in Almaty, so the local day is the UTC one.
+        return (clock.now - datetime.timedelta(days=days_ago)).date().isoformat()
+
+    assert [row for row in rows if row[0] == 'call'] == [
+        ('call', CHAT, 5, None, 1, stamp(60), day(60)),
+        ('call', CHAT, 4, None, 2, stamp(10), day(10)),
+        ('call', CHAT, 1, None, 3, stamp(0), day(0)),
+        ('call', CHAT, 2, None, 4, stamp(0), day(0)),
+    ]
+    assert sorted(row for row in rows if row[0] == 'rsvp') == [
+        ('rsvp', CHAT, 1, 100, None, stamp(0), day(0)),
+        ('rsvp', CHAT, 2, 50, None, stamp(1), day(1)),
+        ('rsvp', CHAT, 3, 101, None, stamp(0), day(0)),
+        ('rsvp', CHAT, 3, 102, None, stamp(0), day(0)),
+    ]
+
+def test_maintenance_keeps_all_time_ranking(store, clock):
+    seed_history(store, clock)
+    all_time = store.get_smoke_leaderboard_for_period(CHAT, 'all')
+    assert store.run_maintenance()["events_deleted"] == 0
+
+    clock.set(days_ago=-100)
+    stats = store.run_maintenance()
+    assert (stats["events_deleted"], stats["participation_deleted"]) == (5, 5)
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'all') == all_time
+    rows, _, _ = store.get_leaderboard_page(CHAT, 'all')
+    assert [(name, count) for _, name, count, _ in rows] == all_time
+    assert store.get_smoke_leaderboard_for_period(CHAT, 'month') == []
+    assert list(store.iter_chat_history(CHAT)) == []
@@ -0,0 +1,33 @@
+import collections
+import random
+import threading
+import storage
+import writebehind
+
+def test_concurrent_toggles_match_their_parity(tmp_path, monkeypatch):
+    # A tiny state cache forces evictions while toggles are still reading committed state.
+    monkeypatch.setattr(writebehind, "STATE_CACHE_SIZE", 5)
+    inner = storage.SQLiteStorage(str(tmp_path / "smoke.db"))
+    inner.init()
+    store = writebehind.WriteBehindStorage(inner, flush_interval_ms=1, max_batch=8)
+
+    toggles = collections.Counter()
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(300):
+            key = (rng.randrange(6), -1, rng.randrange(8))
+            store.toggle_smoke_participation(*key)
+            with lock:
+                toggles[key] += 1
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+
+    for (user_id, chat_id, message_id), count in toggles.items():
+        assert inner.is_participating(user_id, chat_id, message_id) == (count % 2 == 1)
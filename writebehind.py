@@ -0,0 +1,188 @@
+import collections
+import datetime
+import logging
+import os
+import threading
+from storage import LEADERBOARD_PAGE_SIZE, Storage
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "5"))
+MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "256"))
+# Committed RSVP states kept in memory so repeated toggles skip the existence check.
+STATE_CACHE_SIZE = 10000
+
+class WriteBehindStorage(Storage):
+    """Storage wrapper that group-commits smoke events and RSVP toggles.
+
+    log_smoke_event() and toggle_smoke_participation() only queue the write and
+    return; a background thread applies the queue through the wrapped storage's
+    apply_writes() in one transaction every FLUSH_INTERVAL_MS or MAX_BATCH writes.
+    Toggle results come from an overlay of known RSVP states: every queued state plus
+    the most recently committed ones. Writes must all go through this wrapper for the
+    overlay to stay correct. Reads go to the wrapped storage and may lag by one flush
+    interval. close() commits everything still queued.
+    """
+
+    def __init__(self, inner, flush_interval_ms=FLUSH_INTERVAL_MS, max_batch=MAX_BATCH):
+        super().__init__()
+        self.inner = inner
+        self._flush_interval = flush_interval_ms / 1000
+        self._max_batch = max_batch
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._seq = 0
+        # (user_id, chat_id, message_id) -> (joined, seq of the write), least recently used first
+        self._overlay = collections.OrderedDict()
+        self._evictions = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _enqueue(self, op):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindStorage is closed")
+            self._seq += 1
+            self._pending.append(op)
+            if op[0] == 'rsvp':
+                key = (op[1], op[2], op[3])
+                self._overlay[key] = (op[4], self._seq)
+                self._overlay.move_to_end(key)
+            if len(self._pending) == 1 or len(self._pending) >= self._max_batch:
+                self._cond.notify()
+            return self._seq
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+                if len(self._pending) < self._max_batch and not self._closed:
+                    # Give concurrent writes a moment to join this group commit.
+                    self._cond.wait(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, will retry: {e}")
+                with self._cond:
+                    if self._closed:
+                        return
+                    self._cond.wait(max(self._flush_interval, 0.1))
+
+    def flush(self):
+        """Synchronously commit everything queued so far."""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                flushed_seq = self._seq
+            if not batch:
+                return
+            try:
+                self.inner.apply_writes(batch)
+            except Exception:
+                with self._cond:
+                    self._pending[:0] = batch
+                raise
+            with self._cond:
+                # Entries are moved to the end on every write, so the overlay is in seq order
+                # and evicting from the front stops at the first state still queued; queued
+                # states are the source of truth and must stay.
+                while len(self._overlay) > STATE_CACHE_SIZE:
+                    key, (_, seq) = next(iter(self._overlay.items()))
+                    if seq > flushed_seq:
+                        break
+                    del self._overlay[key]
+                    self._evictions += 1
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        # Anything left because the last flush failed gets one more synchronous try.
+        self.flush()
+        self.inner.close()
+
+    def log_smoke_event(self, chat_id, user_id):
+        self._enqueue(('event', chat_id, user_id, datetime.datetime.now(datetime.timezone.utc)))
+
+    def toggle_smoke_participation(self, user_id, chat_id, message_id):
+        key = (user_id, chat_id, message_id)
+        committed = None
+        evictions = None
+        while True:
+            with self._cond:
+                state = self._overlay.get(key)
+                # Without an eviction in between, a key still missing from the overlay has
+                # had no write since the committed state was read.
+                if state is not None or (committed is not None and self._evictions == evictions):
+                    joined = not (state[0] if state is not None else committed)
+                    self._enqueue(('rsvp', user_id, chat_id, message_id, joined, datetime.datetime.now(datetime.timezone.utc)))
+                    return joined
+                evictions = self._evictions
+            # Read outside the lock so other writers and the flush never wait on disk I/O.
+            committed = self.inner.is_participating(user_id, chat_id, message_id)
+
+    def is_participating(self, user_id, chat_id, message_id):
+        with self._cond:
+            state = self._overlay.get((user_id, chat_id, message_id))
+        if state is not None:
+            return state[0]
+        return self.inner.is_participating(user_id, chat_id, message_id)
+
+    def apply_writes(self, ops):
+        for op in ops:
+            self._enqueue(op)
+
+    def init(self):
+        self.inner.init()
+
+    def add_or_update_user(self, user_id, mention_name):
+        self.inner.add_or_update_user(user_id, mention_name)
+
+    def set_user_active(self, user_id, is_active):
+        self.inner.set_user_active(user_id, is_active)
+
+    def is_user_active(self, user_id):
+        return self.inner.is_user_active(user_id)
+
+    def get_active_users(self):
+        return self.inner.get_active_users()
+
+    def get_chat_timezone(self, chat_id):
+        return self.inner.get_chat_timezone(chat_id)
+
+    def set_chat_timezone(self, chat_id, tz_name):
+        self.inner.set_chat_timezone(chat_id, tz_name)
+
+    def get_smoke_stats(self, chat_id):
+        return self.inner.get_smoke_stats(chat_id)
+
+    def get_smoke_leaderboard(self, chat_id):
+        return self.inner.get_smoke_leaderboard(chat_id)
+
+    def get_monthly_stats(self, chat_id):
+        return self.inner.get_monthly_stats(chat_id)
+
+    def get_smoke_leaderboard_for_period(self, chat_id, period='week', limit=10):
+        return self.inner.get_smoke_leaderboard_for_period(chat_id, period, limit)
+
+    def get_leaderboard_ranking(self, chat_id, period='week'):
+        return self.inner.get_leaderboard_ranking(chat_id, period)
+
+    def get_leaderboard_page(self, chat_id, period='week', after=None, before=None, page_size=LEADERBOARD_PAGE_SIZE):
+        # The wrapped storage's snapshots are the ones invalidated when a batch commits.
+        return self.inner.get_leaderboard_page(chat_id, period, after, before, page_size)
+
+    def get_smoke_history(self, chat_id, limit=5):
+        return self.inner.get_smoke_history(chat_id, limit)
+
+    def iter_chat_history(self, chat_id, chunk_size=1000):
+        return self.inner.iter_chat_history(chat_id, chunk_size)
+
+    def run_maintenance(self):
+        return self.inner.run_maintenance()